@@ -0,0 +1,508 @@
+"""字幕转语音性能基准测试
+
+用法:
+    python benchmark.py mixer --lines 100 500 2000 --minutes 5 30 120
+    python benchmark.py timefit --segments 200 --speed 1.2 1.6
+    python benchmark.py pipeline --cues 100 1000 10000 --compare benchmarks/baseline.json
+    python benchmark.py tts-session --requests 200 --handshake 0.15 --drop-after 20
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from xml.sax.saxutils import unescape
+
+import numpy as np
+import pysubs2
+from pydub import AudioSegment
+
+from subtitle_to_speech import (
+    DEFAULT_TIME_STRETCH,
+    DUB_SAMPLE_RATE,
+    STREAM_WINDOW_SECONDS,
+    DubTimeline,
+    EdgeTTSSessionPool,
+    OUTPUT_CHANNELS,
+    OUTPUT_SAMPLE_RATE,
+    OVERLAP_GAIN_DB,
+    TIME_STRETCH_ENGINES,
+    LocalTTSBackend,
+    PipelineMetrics,
+    convert_subtitle_headless,
+    get_time_stretcher,
+    mix_window,
+)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "benchmarks", "baseline.json")
+
+
+def make_segments(lines, minutes, segment_ms=1500, seed=0):
+    """生成均匀分布在时间轴上的随机语音片段，返回 [(开始毫秒, int16 数组)]"""
+    rng = np.random.default_rng(seed)
+    duration_ms = minutes * 60 * 1000
+    step = max(1, (duration_ms - segment_ms) // max(1, lines))
+    frames = segment_ms * DUB_SAMPLE_RATE // 1000
+    return [
+        (i * step, rng.integers(-8000, 8000, size=(frames, 1), dtype=np.int16))
+        for i in range(lines)
+    ], duration_ms
+
+
+def mix_with_overlay(segments, duration_ms):
+    """旧的做法：每条字幕调用一次 AudioSegment.overlay"""
+    dubbed_audio = AudioSegment.silent(duration=duration_ms, frame_rate=DUB_SAMPLE_RATE)
+    for start, samples in segments:
+        segment = AudioSegment(samples.tobytes(), frame_rate=DUB_SAMPLE_RATE,
+                               sample_width=2, channels=1)
+        dubbed_audio = dubbed_audio.overlay(segment, position=start,
+                                            gain_during_overlay=OVERLAP_GAIN_DB)
+    return dubbed_audio
+
+
+def mix_with_timeline(segments, duration_ms):
+    """转换流程中的做法：DubTimeline 按窗口渲染，再用 mix_window 生成输出采样"""
+    timeline = DubTimeline(sample_rate=DUB_SAMPLE_RATE)
+    try:
+        for start, samples in segments:
+            timeline.add(samples, start)
+        total_frames = timeline.ms_to_frames(duration_ms)
+        window_frames = DUB_SAMPLE_RATE * STREAM_WINDOW_SECONDS
+        return b"".join(
+            mix_window(timeline.render(start, min(window_frames, total_frames - start)))
+            for start in range(0, total_frames, window_frames)
+        )
+    finally:
+        timeline.arena.close()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_mixer(args):
+    """比较两种时间轴拼接方式随字幕条数和时长的变化"""
+    print(f"{'字幕条数':>8} {'时长(分)':>8} {'overlay(秒)':>12} {'timeline(秒)':>13} {'加速比':>8}")
+    for minutes in args.minutes:
+        for lines in args.lines:
+            segments, duration_ms = make_segments(lines, minutes)
+            timeline = timed(mix_with_timeline, segments, duration_ms)
+            if lines * minutes <= args.legacy_limit:
+                overlay = timed(mix_with_overlay, segments, duration_ms)
+                overlay_text = f"{overlay:12.3f}"
+                speedup_text = f"{overlay / timeline:7.1f}x"
+            else:
+                # 旧方法的耗时与 条数×时长 成正比，规模过大时跳过
+                overlay_text = f"{'跳过':>12}"
+                speedup_text = f"{'-':>8}"
+            print(f"{lines:>8} {minutes:>8} {overlay_text} {timeline:13.3f} {speedup_text}")
+
+
+def make_speech_like(count, seconds, sample_rate=OUTPUT_SAMPLE_RATE, seed=0):
+    """生成带音节起伏的谐波信号，近似语音片段"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    segments = []
+    for _ in range(count):
+        f0 = rng.uniform(120, 260)
+        tone = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 6) * t) ** 2
+        segments.append((tone * envelope * 6000).astype(np.int16))
+    return segments
+
+
+def stretch_with_pydub(items):
+    """旧的做法：pydub speedup"""
+    outputs = []
+    for samples, speed in items:
+        segment = AudioSegment(samples.tobytes(), frame_rate=OUTPUT_SAMPLE_RATE,
+                               sample_width=2, channels=1)
+        outputs.append(segment.speedup(playback_speed=speed))
+    return outputs
+
+
+def bench_timefit(args):
+    """各变速引擎每秒能处理的音频分钟数"""
+    segments = make_speech_like(args.segments, args.seconds)
+    audio_minutes = args.segments * args.seconds / 60
+    engines = [("pydub", stretch_with_pydub)] + [
+        (name, get_time_stretcher(name).stretch_batch) for name in sorted(TIME_STRETCH_ENGINES)
+    ]
+    print(f"{'引擎':>8} {'倍速':>6} {'耗时(秒)':>10} {'音频分钟/秒':>12}")
+    for speed in args.speed:
+        items = [(samples, speed) for samples in segments]
+        for name, func in engines:
+            elapsed = timed(func, items)
+            print(f"{name:>8} {speed:>6.2f} {elapsed:10.3f} {audio_minutes / elapsed:12.2f}")
+
+
+# 合成字幕使用的汉字
+CJK_TEXT = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+
+
+def make_subtitle_file(path, cues, density=0.6, overlap=0.05, seed=0):
+    """生成合成字幕，返回时间轴总时长（毫秒）
+
+    density 为语音覆盖时间轴的比例，overlap 为与上一条字幕重叠的比例。
+    文本长度按本地后端的语速估算，约三分之一的字幕偏长，需要变速。
+    格式由扩展名决定 (.srt / .ass)。
+    """
+    rng = np.random.default_rng(seed)
+    subs = pysubs2.SSAFile()
+    position = 1000
+    for _ in range(cues):
+        duration = int(rng.uniform(1000, 4000))
+        if subs and rng.random() < overlap:
+            start = max(0, subs[-1].end - int(rng.uniform(200, 800)))
+        else:
+            gap = duration * (1 - density) / density
+            start = position + int(rng.uniform(0.5, 1.5) * gap)
+        chars = max(1, int(duration / 1000 * LocalTTSBackend().chars_per_second
+                           * rng.uniform(0.6, 1.4)))
+        text = "".join(rng.choice(list(CJK_TEXT), size=chars))
+        subs.append(pysubs2.SSAEvent(start=start, end=start + duration, text=text))
+        position = max(position, start + duration)
+    subs.save(path)
+    return position + 1000
+
+
+def make_background(path, seconds, seed=0, chunk_seconds=10):
+    """分块写入合成的立体声背景音频 (WAV)，内存占用与时长无关"""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * OUTPUT_SAMPLE_RATE)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(OUTPUT_CHANNELS)
+        f.setsampwidth(2)
+        f.setframerate(OUTPUT_SAMPLE_RATE)
+        for offset in range(0, total, chunk_seconds * OUTPUT_SAMPLE_RATE):
+            frames = min(chunk_seconds * OUTPUT_SAMPLE_RATE, total - offset)
+            t = (offset + np.arange(frames)) / OUTPUT_SAMPLE_RATE
+            music = 3000 * np.sin(2 * np.pi * 110 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 0.25 * t))
+            noise = rng.normal(0, 800, size=(frames, OUTPUT_CHANNELS))
+            samples = np.clip(music[:, None] + noise, -32768, 32767).astype(np.int16)
+            f.writeframes(samples.tobytes())
+
+
+def count_ffmpeg_processes():
+    """统计本进程启动的 ffmpeg/ffprobe 子进程数，返回计数字典"""
+    counter = {'ffmpeg_processes': 0}
+    original_init = subprocess.Popen.__init__
+
+    def counting_init(self, args, *rest, **kwargs):
+        program = args[0] if isinstance(args, (list, tuple)) else str(args).split()[0]
+        if os.path.basename(str(program)).startswith(('ffmpeg', 'ffprobe')):
+            counter['ffmpeg_processes'] += 1
+        original_init(self, args, *rest, **kwargs)
+
+    subprocess.Popen.__init__ = counting_init
+    return counter
+
+
+def run_pipeline_case(case):
+    """在独立进程中运行一次完整转换，返回测量结果
+
+    每个用例使用新的进程，峰值内存和 ffmpeg 进程数互不影响。背景音频默认
+    与字幕等长，指定 background_seconds 时比字幕短的背景循环播放。
+    """
+    counter = count_ffmpeg_processes()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        subtitle_path = os.path.join(temp_dir, f"bench.{case['format']}")
+        duration_ms = make_subtitle_file(subtitle_path, case['cues'], case['density'],
+                                         case['overlap'], case['seed'])
+        media_path = None
+        if case['background']:
+            media_path = os.path.join(temp_dir, "background.wav")
+            seconds = case.get('background_seconds') or duration_ms / 1000
+            make_background(media_path, seconds, case['seed'])
+
+        backend = LocalTTSBackend(latency=case['latency'])
+        metrics = PipelineMetrics()
+        start = time.perf_counter()
+        convert_subtitle_headless(
+            subtitle_path, media_path,
+            concurrency=case['concurrency'],
+            keep_audio=False,
+            time_stretch=case['time_stretch'],
+            group_cues=case.get('group_cues', 0),
+            backend=backend,
+            metrics=metrics,
+            log=lambda *_: None
+        )
+        wall = time.perf_counter() - start
+
+    data = metrics.to_dict()
+    audio_minutes = duration_ms / 60000
+    return {
+        'wall_seconds': wall,
+        'audio_minutes': audio_minutes,
+        'audio_minutes_per_second': audio_minutes / wall,
+        'peak_rss_mb': (data['peak_rss_bytes'] or 0) / 1024 / 1024,
+        'ffmpeg_processes': counter['ffmpeg_processes'],
+        'tts_requests': data['tts_latency'].get('count', 0),
+        'stages': data['stages'],
+    }
+
+
+def case_name(case):
+    name = f"{case['format']}-{case['cues']}-d{case['density']}-o{case['overlap']}"
+    if case['background']:
+        name += f"-bg{case['background_seconds']:g}s" if case.get('background_seconds') else "-bg"
+    return name + (f"-g{case['group_cues']}" if case.get('group_cues') else "")
+
+
+# 与基准比较时检查的指标，True 表示数值越大越好
+COMPARED_METRICS = {
+    'wall_seconds': False,
+    'audio_minutes_per_second': True,
+    'peak_rss_mb': False,
+    'ffmpeg_processes': False,
+}
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """打印与基准的差异，返回变差超过 tolerance 的指标列表"""
+    regressions = []
+    print(f"\n{'用例':<28} {'指标':<26} {'基准':>10} {'当前':>10} {'变化':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<28} (基准中没有该用例)")
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = baseline[name][metric], result[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = " ⚠️"
+                regressions.append((name, metric))
+            print(f"{name:<28} {metric:<26} {old:10.2f} {new:10.2f} {change:+7.1%}{flag}")
+    return regressions
+
+
+def bench_pipeline(args):
+    """用合成字幕和离线后端测量完整流程的吞吐量"""
+    cases = [
+        dict(format=fmt, cues=cues, density=args.density, overlap=args.overlap,
+             background=not args.no_background, latency=args.latency,
+             background_seconds=args.background_seconds, concurrency=args.concurrency,
+             time_stretch=args.time_stretch, seed=args.seed, group_cues=group_cues)
+        for fmt in args.format for cues in args.cues for group_cues in args.group_cues
+    ]
+    print(f"{'用例':<28} {'耗时(秒)':>10} {'音频分钟':>10} {'音频分钟/秒':>12} "
+          f"{'峰值内存(MB)':>12} {'ffmpeg进程':>10} {'合成请求':>8}")
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_pipeline_case, (case,))
+        results[case_name(case)] = result
+        print(f"{case_name(case):<28} {result['wall_seconds']:10.2f} "
+              f"{result['audio_minutes']:10.1f} {result['audio_minutes_per_second']:12.2f} "
+              f"{result['peak_rss_mb']:12.0f} {result['ffmpeg_processes']:10d} "
+              f"{result['tts_requests']:8d}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n基准已保存: {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} 项指标比基准差 {args.tolerance:.0%} 以上")
+            return 1
+        print("\n✓ 没有超出容差的性能退化")
+    return 0
+
+
+class EdgeTTSStubServer:
+    """本地模拟的 edge-tts websocket 服务
+
+    握手前等待 handshake 秒模拟 TLS 和鉴权开销，每个请求等待 latency 秒后
+    按 edge-tts 的消息格式返回 turn.start、音频块、每个字的词边界和 turn.end。
+    drop_after 不为 0 时每条连接处理这么多请求后由服务端关闭，用于测试断线
+    重连。audio 为根据文本生成音频数据的函数，默认返回与文本长度成正比的
+    填充数据；词边界按 48 kbps 码率换算的音频时长平均分给每个字。
+    """
+
+    def __init__(self, handshake=0.0, latency=0.0, drop_after=0, audio=None):
+        self.handshake = handshake
+        self.latency = latency
+        self.drop_after = drop_after
+        self.audio = audio or (lambda text: b"\xff" * (720 * max(1, len(text))))
+        self.connections = 0
+        self.requests = 0
+        self.url = None
+        self._runner = None
+
+    async def __aenter__(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}/"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
+
+    async def _handle(self, request):
+        from aiohttp import WSMsgType, web
+        await asyncio.sleep(self.handshake)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        served = 0
+        async for message in ws:
+            if message.type != WSMsgType.TEXT or "Path:ssml" not in message.data:
+                continue
+            request_id = re.search(r"X-RequestId:(\w+)", message.data).group(1)
+            text = unescape(re.search(r"<prosody[^>]*>(.*)</prosody>", message.data, re.S).group(1))
+            await asyncio.sleep(self.latency)
+            prefix = f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\n"
+            await ws.send_str(f"{prefix}Path:turn.start\r\n\r\n{{}}")
+            data = self.audio(text)
+            header = (f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\n"
+                      "Path:audio\r\n").encode()
+            for start in range(0, len(data), 4096):
+                await ws.send_bytes(len(header).to_bytes(2, 'big') + header
+                                    + data[start:start + 4096])
+            chars = [(n, char) for n, char in enumerate(text) if not char.isspace()]
+            ticks = len(data) * 8 * 10_000_000 // 48_000 // max(1, len(text))
+            for n, char in chars:
+                metadata = {"Metadata": [{"Type": "WordBoundary", "Data": {
+                    "Offset": n * ticks, "Duration": ticks, "text": {"Text": char}}}]}
+                await ws.send_str(f"{prefix}Path:audio.metadata\r\n\r\n"
+                                  + json.dumps(metadata, ensure_ascii=False))
+            await ws.send_str(f"{prefix}Path:turn.end\r\n\r\n{{}}")
+            self.requests += 1
+            served += 1
+            if self.drop_after and served >= self.drop_after:
+                break
+        await ws.close()
+        return ws
+
+
+async def run_tts_session_case(args, reuse, drop_after=None, requests=None):
+    """通过模拟服务合成 requests 句，返回 (耗时, 建立的连接数, 失败数)
+
+    drop_after 和 requests 默认取 args 中的设置。
+    """
+    drop_after = args.drop_after if drop_after is None else drop_after
+    requests = requests or args.requests
+    async with EdgeTTSStubServer(args.handshake, args.latency, drop_after) as server:
+        pool = EdgeTTSSessionPool(args.concurrency, url=server.url,
+                                  max_requests=None if reuse else 1)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def request(index):
+            async with semaphore:
+                async for _ in pool.stream(f"第{index}句测试文本", "zh-CN-XiaoxiaoNeural",
+                                           "+0%", "+0%"):
+                    pass
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(request(i) for i in range(requests)),
+                                       return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        await pool.close()
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    return elapsed, pool.connects, failed
+
+
+# 断线重连检查：服务端每处理这么多请求就断开连接
+RECONNECT_CHECK_DROPS = (2, 3)
+RECONNECT_CHECK_REQUESTS = 100
+
+
+def bench_tts_session(args):
+    """比较复用 websocket 连接与每句新建连接的合成吞吐量
+
+    之后在服务端频繁断开连接的情况下再各运行一次，复用的连接失效时应当
+    透明地重连，出现任何失败都返回 1。
+    """
+    print(f"{'模式':>10} {'耗时(秒)':>10} {'请求/秒':>10} {'连接数':>8} {'失败':>6}")
+    cases = [(reuse, "复用连接" if reuse else "每句新建", None, None) for reuse in (False, True)]
+    cases += [(True, f"{drop}次断开", drop, RECONNECT_CHECK_REQUESTS)
+              for drop in RECONNECT_CHECK_DROPS]
+    failed_total = 0
+    for reuse, label, drop_after, requests in cases:
+        elapsed, connects, failed = asyncio.run(
+            run_tts_session_case(args, reuse, drop_after, requests)
+        )
+        failed_total += failed
+        print(f"{label:>10} {elapsed:10.2f} "
+              f"{(requests or args.requests) / elapsed:10.1f} {connects:8d} {failed:6d}")
+    return 1 if failed_total else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="字幕转语音性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mixer = subparsers.add_parser("mixer", help="时间轴混音：overlay 与预分配缓冲区对比")
+    mixer.add_argument("--lines", type=int, nargs="+", default=[100, 500, 2000])
+    mixer.add_argument("--minutes", type=int, nargs="+", default=[5, 30, 120])
+    mixer.add_argument("--legacy-limit", type=int, default=10000,
+                       help="条数×分钟 超过该值时不运行 overlay 对照组")
+    mixer.set_defaults(func=bench_mixer)
+
+    timefit = subparsers.add_parser("timefit", help="语音变速引擎吞吐量")
+    timefit.add_argument("--segments", type=int, default=200)
+    timefit.add_argument("--seconds", type=float, default=3.0, help="每个片段的时长")
+    timefit.add_argument("--speed", type=float, nargs="+", default=[1.2, 1.6])
+    timefit.set_defaults(func=bench_timefit)
+
+    pipeline = subparsers.add_parser("pipeline", help="完整流程吞吐量（合成字幕 + 离线语音后端）")
+    pipeline.add_argument("--cues", type=int, nargs="+", default=[100, 1000])
+    pipeline.add_argument("--format", nargs="+", choices=["srt", "ass"], default=["srt"])
+    pipeline.add_argument("--density", type=float, default=0.6, help="语音覆盖时间轴的比例")
+    pipeline.add_argument("--overlap", type=float, default=0.05, help="与上一条字幕重叠的比例")
+    pipeline.add_argument("--no-background", action="store_true", help="不生成背景音频")
+    pipeline.add_argument("--background-seconds", type=float,
+                          help="背景音频的时长（秒），默认与字幕等长，较短时循环播放")
+    pipeline.add_argument("--latency", type=float, default=0.0, help="模拟的单句合成延迟（秒）")
+    pipeline.add_argument("--concurrency", type=int, default=8)
+    pipeline.add_argument("--time-stretch", choices=sorted(TIME_STRETCH_ENGINES),
+                          default=DEFAULT_TIME_STRETCH)
+    pipeline.add_argument("--group-cues", type=int, nargs="+", default=[0],
+                          help="每次合成请求合并的字幕条数，0 表示逐条合成")
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument("--save-baseline", metavar="FILE", help="把结果保存为基准")
+    pipeline.add_argument("--compare", metavar="FILE", nargs="?", const=DEFAULT_BASELINE,
+                          help=f"与基准比较 (默认 {os.path.relpath(DEFAULT_BASELINE)})")
+    pipeline.add_argument("--tolerance", type=float, default=0.15,
+                          help="允许的性能退化比例 (默认 0.15)")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    session = subparsers.add_parser("tts-session", help="语音合成连接复用（本地模拟服务）")
+    session.add_argument("--requests", type=int, default=200)
+    session.add_argument("--concurrency", type=int, default=8)
+    session.add_argument("--handshake", type=float, default=0.15, help="模拟的建立连接耗时（秒）")
+    session.add_argument("--latency", type=float, default=0.05, help="模拟的单句合成延迟（秒）")
+    session.add_argument("--drop-after", type=int, default=0,
+                         help="每条连接处理这么多请求后由服务端断开 (0 表示不断开)")
+    session.set_defaults(func=bench_tts_session)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,54 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+except ImportError:  # 没有图形环境的服务器上只能使用命令行模式
+    tk = None
 import pysubs2
 import os
+import argparse
 import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import csv
+import functools
 import edge_tts
+import io
+import numpy as np
 from pydub import AudioSegment
 import tempfile
 import time
+import unicodedata
+import wave
 import sys
 import subprocess
-from pygame import mixer
 import threading
+from collections import OrderedDict, deque
 from datetime import datetime
-from queue import Queue
-import gc
+from queue import Empty, Queue
+import hashlib
+import json
+import mmap
+import random
+import shutil
+import ssl
 import warnings
+from xml.sax.saxutils import escape, unescape
+
+try:
+    # 复用 websocket 连接需要 edge-tts 的内部接口，旧版本退回每句新建连接
+    import aiohttp
+    import certifi
+    from edge_tts import communicate as edge_communicate
+    from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+    from edge_tts.data_classes import TTSConfig
+    from edge_tts.drm import DRM
+    from edge_tts.exceptions import NoAudioReceived, UnexpectedResponse, UnknownResponse
+    if not hasattr(DRM, 'headers_with_muid'):
+        raise ImportError("edge-tts 版本过旧")
+    EDGE_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+except ImportError:
+    aiohttp = edge_communicate = None
 
 if sys.platform.startswith('win'):
     # 禁用 ProactorEventLoop 的警告
@@ -22,8 +56,3330 @@ if sys.platform.startswith('win'):
     # 使用 WindowsSelectorEventLoopPolicy
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
+# 同时进行的语音合成请求数
+DEFAULT_TTS_CONCURRENCY = 8
+MAX_TTS_CONCURRENCY = 32
+
+# 合成失败的重试次数和退避延迟（秒），实际延迟带随机抖动
+TTS_MAX_RETRIES = 3
+TTS_RETRY_BASE_DELAY = 1.0
+TTS_RETRY_MAX_DELAY = 8.0
+
+
+def is_throttle_error(error):
+    """判断异常是否由服务端限流引起"""
+    if getattr(error, 'status', None) == 429:
+        return True
+    message = str(error).lower()
+    return any(key in message for key in ('429', 'too many requests', 'throttl', 'rate limit'))
+
+
+class TTSThrottle:
+    """并发合成任务共享的限流退避状态"""
+
+    def __init__(self, base_delay=1.0, max_delay=30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0
+        self.resume_at = 0
+
+    async def wait(self):
+        """服务限流期间暂停发出新请求"""
+        while True:
+            remaining = self.resume_at - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def on_throttled(self):
+        """记录一次限流，指数增加所有任务的冷却时间"""
+        self.delay = min(self.max_delay, self.delay * 2 if self.delay else self.base_delay)
+        # 加入随机抖动，避免冷却结束后所有任务同时发起请求
+        resume_at = time.monotonic() + self.delay * random.uniform(1.0, 1.5)
+        self.resume_at = max(self.resume_at, resume_at)
+        return self.delay
+
+    def on_success(self):
+        """请求成功后逐步缩短冷却时间"""
+        self.delay = self.delay / 2 if self.delay >= self.base_delay else 0
+
+
+class TTSBackend:
+    """语音合成后端接口
+
+    后端负责把一句文本合成为音频数据并列出可用语音。suffix 为音频数据
+    对应的文件扩展名，version 参与缓存键的计算，后端升级后旧缓存自动失效。
+    """
+
+    name = ""
+    suffix = ".mp3"
+    version = ""
+    connections = 0  # 累计建立的网络连接数
+
+    async def synthesize(self, text, voice, rate, volume):
+        """合成一句文本，返回音频数据 (bytes)"""
+        raise NotImplementedError
+
+    async def synthesize_with_boundaries(self, text, voice, rate, volume):
+        """合成文本，返回 (音频数据, [(开始秒数, 持续秒数, 词)])
+
+        capabilities() 中 boundaries 为 True 的后端才支持。
+        """
+        raise NotImplementedError
+
+    async def stream(self, text, voice, rate, volume):
+        """合成一句文本，边合成边逐块返回音频数据；不支持流式的后端一次返回全部数据"""
+        yield await self.synthesize(text, voice, rate, volume)
+
+    async def list_voices(self):
+        """返回与 edge_tts.list_voices() 格式相同的语音列表"""
+        raise NotImplementedError
+
+    async def close(self):
+        """释放后端持有的网络连接，在事件循环结束前调用"""
+
+    def capabilities(self):
+        """后端支持的功能"""
+        return {
+            'rate': True,  # 支持调节语速
+            'volume': True,  # 支持调节音量
+            'network': False,  # 需要网络连接
+            'boundaries': False,  # 支持 synthesize_with_boundaries()
+        }
+
+
+def is_connection_error(error):
+    """判断异常是否由连接断开引起，这类错误换一条连接即可立即重试"""
+    if isinstance(error, (ConnectionError, asyncio.TimeoutError)):
+        return True
+    return aiohttp is not None and isinstance(
+        error, (aiohttp.ClientConnectionError, aiohttp.WSServerHandshakeError)
+    )
+
+
+class EdgeTTSConnection:
+    """一条 edge-tts websocket 连接，依次处理多次合成请求"""
+
+    def __init__(self, session, websocket):
+        self.session = session
+        self.websocket = websocket
+        self.requests = 0
+        self.last_used = time.monotonic()
+        self._configured = False
+
+    @property
+    def closed(self):
+        return self.websocket.closed
+
+    async def stream(self, text, voice, rate, volume):
+        """发送一次合成请求，按 edge_tts.Communicate.stream() 的格式逐块返回
+
+        音频块为 {"type": "audio", "data": ...}，词边界为 {"type": "WordBoundary",
+        "offset": ..., "duration": ..., "text": ...}，时间单位为 100 纳秒。
+        """
+        if not self._configured:
+            # 输出格式和元数据选项对整条连接有效，只需发送一次
+            await self.websocket.send_str(
+                f"X-Timestamp:{edge_communicate.date_to_string()}\r\n"
+                "Content-Type:application/json; charset=utf-8\r\n"
+                "Path:speech.config\r\n\r\n"
+                '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+                '"sentenceBoundaryEnabled":"false","wordBoundaryEnabled":"true"},'
+                '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n'
+            )
+            self._configured = True
+        self.requests += 1
+
+        config = TTSConfig(voice, rate, volume, "+0Hz", "WordBoundary")
+        received_audio = False
+        audio_bytes = 0
+        texts = edge_communicate.split_text_by_byte_length(
+            escape(edge_communicate.remove_incompatible_characters(text)), 4096
+        )
+        for partial_text in texts:
+            # 长文本分几次请求，后面各段的词边界从前面音频的总时长算起
+            # (输出为 48 kbps 固定码率)
+            offset_compensation = audio_bytes * 8 * 10_000_000 // 48_000
+            await self.websocket.send_str(edge_communicate.ssml_headers_plus_data(
+                edge_communicate.connect_id(),
+                edge_communicate.date_to_string(),
+                edge_communicate.mkssml(config, partial_text)
+            ))
+            while True:
+                message = await self.websocket.receive()
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    data = message.data.encode('utf-8')
+                    headers, body = edge_communicate.get_headers_and_data(
+                        data, data.find(b"\r\n\r\n")
+                    )
+                    path = headers.get(b"Path")
+                    if path == b"turn.end":
+                        break
+                    if path == b"audio.metadata":
+                        for item in json.loads(body)["Metadata"]:
+                            if item["Type"] == "WordBoundary":
+                                yield {
+                                    "type": "WordBoundary",
+                                    "offset": item["Data"]["Offset"] + offset_compensation,
+                                    "duration": item["Data"]["Duration"],
+                                    "text": unescape(item["Data"]["text"]["Text"]),
+                                }
+                    elif path not in (b"response", b"turn.start"):
+                        raise UnknownResponse(f"未知的响应: {path!r}")
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    header_length = int.from_bytes(message.data[:2], 'big')
+                    headers, data = edge_communicate.get_headers_and_data(
+                        message.data, header_length
+                    )
+                    if headers.get(b"Path") != b"audio":
+                        raise UnexpectedResponse("收到的二进制消息不是音频")
+                    if data:
+                        received_audio = True
+                        audio_bytes += len(data)
+                        yield {"type": "audio", "data": data}
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    raise ConnectionResetError(f"连接出错: {self.websocket.exception()}")
+                else:
+                    # 服务端关闭了连接
+                    raise ConnectionResetError("语音服务关闭了连接")
+        self.last_used = time.monotonic()
+        if not received_audio:
+            raise NoAudioReceived("没有收到音频，请检查语音参数")
+
+    async def close(self):
+        await self.websocket.close()
+        await self.session.close()
+
+
+class EdgeTTSSessionPool:
+    """复用的 edge-tts websocket 连接池
+
+    最多同时保持 size 条连接，每条连接依次处理多次合成请求，握手开销不再
+    随字幕条数增加。取出连接时丢弃已断开或空闲超过 idle_timeout 秒的连接；
+    复用的连接在收到数据前失效时透明地换一条新连接重试。max_requests 限制
+    每条连接处理的请求数（1 相当于每句新建连接）。url 和 headers 可以指向
+    本地的模拟服务，用于测试和基准测试。
+
+    连接与事件循环绑定，在新的事件循环中使用时重新建立。空闲连接在所属的
+    事件循环结束前 (asyncio.run 等调用 shutdown_asyncgens 时) 关闭。
+    """
+
+    def __init__(self, size=DEFAULT_TTS_CONCURRENCY, url=None, headers=None,
+                 idle_timeout=60, max_requests=None, connect_timeout=10, receive_timeout=60):
+        self.size = size
+        self.url = url
+        self.headers = headers
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+        self.connects = 0  # 累计建立的连接数
+        self._idle = []
+        self._slots = None
+        self._loop = None
+        self._guard = None
+
+    async def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        idle, self._idle = self._idle, []
+        if idle and self._loop.is_running():
+            # 原来的事件循环仍在其他线程中运行，连接交给它关闭
+            asyncio.run_coroutine_threadsafe(self._close_connections(idle), self._loop)
+        self._loop = loop
+        self._slots = asyncio.Semaphore(max(1, self.size))
+        # 事件循环只在 shutdown_asyncgens 时通知结束：登记一个停在 yield 的
+        # 异步生成器，结束时在这个循环中关闭空闲连接 (循环只保存弱引用)
+        self._guard = self._close_on_shutdown()
+        await self._guard.__anext__()
+
+    async def _close_on_shutdown(self):
+        try:
+            yield
+        finally:
+            if self._loop is asyncio.get_running_loop():
+                await self.close()
+
+    @staticmethod
+    async def _close_connections(connections):
+        for connection in connections:
+            await connection.close()
+
+    async def _connect(self, retry_forbidden=True):
+        if self.url:
+            url, headers, ssl_context = self.url, self.headers or {}, None
+        else:
+            url = (f"{WSS_URL}&ConnectionId={edge_communicate.connect_id()}"
+                   f"&Sec-MS-GEC={DRM.generate_sec_ms_gec()}"
+                   f"&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}")
+            headers = DRM.headers_with_muid(WSS_HEADERS)
+            ssl_context = EDGE_SSL_CONTEXT
+        session = aiohttp.ClientSession(
+            trust_env=True,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+                                          sock_read=self.receive_timeout)
+        )
+        try:
+            websocket = await session.ws_connect(
+                url, compress=15, headers=headers, ssl=ssl_context,
+                receive_timeout=self.receive_timeout
+            )
+        except aiohttp.ClientResponseError as e:
+            await session.close()
+            if e.status == 403 and retry_forbidden and not self.url:
+                # 本机时钟偏差导致的鉴权失败，校正后重试一次
+                DRM.handle_client_response_error(e)
+                return await self._connect(retry_forbidden=False)
+            raise
+        except BaseException:
+            await session.close()
+            raise
+        self.connects += 1
+        return EdgeTTSConnection(session, websocket)
+
+    async def _take_idle(self):
+        while self._idle:
+            connection = self._idle.pop()
+            if (not connection.closed
+                    and time.monotonic() - connection.last_used < self.idle_timeout):
+                return connection
+            await connection.close()
+        return None
+
+    async def stream(self, text, voice, rate, volume):
+        """合成一句文本，逐块返回音频和词边界 (格式见 EdgeTTSConnection.stream)"""
+        await self._bind_loop()
+        async with self._slots:
+            for attempt in range(2):
+                # 重试时直接新建连接，空闲列表中的其他连接可能同样已经断开
+                connection = await self._take_idle() if attempt == 0 else None
+                reused = connection is not None
+                if not reused:
+                    connection = await self._connect()
+                started = False
+                try:
+                    async for chunk in connection.stream(text, voice, rate, volume):
+                        started = True
+                        yield chunk
+                except BaseException as e:
+                    await connection.close()
+                    # 复用的连接可能已被服务端关闭，还没收到数据时换一条新连接
+                    if reused and not started and attempt == 0 and is_connection_error(e):
+                        continue
+                    raise
+                if self.max_requests and connection.requests >= self.max_requests:
+                    await connection.close()
+                else:
+                    self._idle.append(connection)
+                return
+
+    async def close(self):
+        """关闭所有空闲连接"""
+        idle, self._idle = self._idle, []
+        await self._close_connections(idle)
+
+
+class EdgeTTSBackend(TTSBackend):
+    """微软 Edge 在线语音合成
+
+    请求通过 EdgeTTSSessionPool 复用 websocket 连接；安装的 edge-tts 版本
+    不提供所需的内部接口时退回每句新建 edge_tts.Communicate。
+    """
+
+    name = "edge"
+    suffix = ".mp3"
+    version = f"edge-tts/{getattr(edge_tts, '__version__', '')}"
+
+    def __init__(self, pool=None, pool_size=DEFAULT_TTS_CONCURRENCY):
+        if pool is None and edge_communicate is not None:
+            pool = EdgeTTSSessionPool(pool_size)
+        self.pool = pool
+
+    @property
+    def connections(self):
+        return self.pool.connects if self.pool else 0
+
+    async def synthesize(self, text, voice, rate, volume):
+        # 直接收集流式返回的音频块，不经过临时文件
+        return b"".join([chunk async for chunk in self.stream(text, voice, rate, volume)])
+
+    async def synthesize_with_boundaries(self, text, voice, rate, volume):
+        audio = []
+        boundaries = []
+        async for chunk in self._chunks(text, voice, rate, volume):
+            if chunk["type"] == "audio":
+                audio.append(chunk["data"])
+            elif chunk["type"] == "WordBoundary":
+                boundaries.append((chunk["offset"] / 1e7, chunk["duration"] / 1e7, chunk["text"]))
+        return b"".join(audio), boundaries
+
+    async def stream(self, text, voice, rate, volume):
+        async for chunk in self._chunks(text, voice, rate, volume):
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+    async def _chunks(self, text, voice, rate, volume):
+        if self.pool:
+            async for chunk in self.pool.stream(text, voice, rate, volume):
+                yield chunk
+            return
+
+        communicate = edge_tts.Communicate(
+            text,
+            voice,
+            rate=rate,
+            volume=volume
+        )
+        async for chunk in communicate.stream():
+            yield chunk
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+
+    async def list_voices(self):
+        return await edge_tts.list_voices()
+
+    def capabilities(self):
+        return dict(super().capabilities(), network=True, boundaries=True)
+
+
+def encode_wav(samples, sample_rate):
+    """把一维 int16 采样编码为单声道 WAV 数据"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+class LocalTTSError(Exception):
+    """本地合成后端注入的模拟故障"""
+
+
+class LocalTTSBackend(TTSBackend):
+    """离线的确定性合成后端，用于压力测试、基准测试和持续集成
+
+    每个字生成一个共振峰元音音节，时长与文本长度成正比并受语速影响，
+    相同输入总是得到相同的音频。latency 和 jitter 模拟网络延迟，
+    failure_rate 与 throttle_rate 按 (文本, 第几次请求) 确定性地注入
+    普通错误和限流错误。
+    """
+
+    name = "local"
+    suffix = ".wav"
+    version = "local/1"
+
+    # 元音的前两个共振峰 (Hz)
+    FORMANTS = ((730, 1090), (270, 2290), (300, 870), (530, 1840), (570, 840), (440, 1020))
+
+    VOICES = (
+        ("zh-CN-LocalFemaleNeural", "zh-CN", "Female", 220),
+        ("zh-CN-LocalMaleNeural", "zh-CN", "Male", 120),
+        ("en-US-LocalFemaleNeural", "en-US", "Female", 210),
+    )
+
+    def __init__(self, chars_per_second=5.0, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, throttle_rate=0.0, sample_rate=24000):
+        self.chars_per_second = chars_per_second
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.sample_rate = sample_rate
+        self._attempts = {}
+
+    @staticmethod
+    def _fraction(*parts):
+        """把输入映射为 [0, 1) 之间的确定性数值"""
+        digest = hashlib.sha256("\x00".join(map(str, parts)).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+    async def _request(self, text):
+        """模拟一次请求的网络延迟和故障"""
+        attempt = self._attempts.get(text, 0)
+        self._attempts[text] = attempt + 1
+
+        delay = self.latency + self.jitter * self._fraction("delay", text, attempt)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._fraction("throttle", text, attempt) < self.throttle_rate:
+            raise LocalTTSError("429 Too Many Requests (模拟限流)")
+        if self._fraction("failure", text, attempt) < self.failure_rate:
+            raise LocalTTSError("模拟合成失败")
+
+    def _render_wav(self, text, voice, rate, volume, boundaries=None):
+        return encode_wav(self.render(text, voice, rate, volume, boundaries), self.sample_rate)
+
+    async def synthesize(self, text, voice, rate, volume):
+        await self._request(text)
+        # 生成采样是 CPU 密集的计算，放到线程池中，不阻塞事件循环里的其他请求
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._render_wav, text, voice, rate, volume
+        )
+
+    async def synthesize_with_boundaries(self, text, voice, rate, volume):
+        await self._request(text)
+        boundaries = []
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, self._render_wav, text, voice, rate, volume, boundaries
+        )
+        return data, boundaries
+
+    def render(self, text, voice, rate="+0%", volume="+0%", boundaries=None):
+        """生成文本对应的 int16 采样，传入 boundaries 列表时追加每个字的 (开始秒数, 持续秒数, 字)"""
+        speed = max(0.1, 1 + parse_percent(rate) / 100)
+        gain = max(0.0, 1 + parse_percent(volume) / 100)
+        f0 = next((v[3] for v in self.VOICES if v[0] == voice), 180)
+        syllable = int(self.sample_rate / self.chars_per_second / speed)
+
+        t = np.arange(syllable) / self.sample_rate
+        envelope = np.minimum(1, np.minimum(t / 0.02, (t[-1] - t) / 0.04)).clip(0)
+        harmonics = np.arange(1, 16)[:, None]
+        syllables = []
+        position = 0
+        for char in text:
+            if char.isspace() or unicodedata.category(char).startswith('P'):
+                # 标点和空白生成停顿
+                syllables.append(np.zeros(syllable // 2, np.float32))
+                position += syllable // 2
+                continue
+            if boundaries is not None:
+                boundaries.append((position / self.sample_rate, syllable / self.sample_rate, char))
+            position += syllable
+            f1, f2 = self.FORMANTS[ord(char) % len(self.FORMANTS)]
+            pitch = f0 * (0.9 + 0.2 * self._fraction("pitch", char))
+            freqs = harmonics * pitch
+            # 用两个共振峰给各次谐波加权，得到元音的音色
+            weights = (np.exp(-((freqs - f1) / 150) ** 2) + 0.7 * np.exp(-((freqs - f2) / 200) ** 2)) / harmonics
+            wave_data = (weights * np.sin(2 * np.pi * freqs * t)).sum(axis=0)
+            syllables.append((wave_data / max(1e-6, np.abs(wave_data).max()) * envelope).astype(np.float32))
+
+        if not syllables:
+            syllables.append(np.zeros(syllable, np.float32))
+        samples = np.concatenate(syllables) * 12000 * gain
+        return np.clip(samples, -32768, 32767).astype(np.int16)
+
+    async def list_voices(self):
+        return [
+            {
+                'Name': f"Local Voice ({short_name})",
+                'ShortName': short_name,
+                'FriendlyName': f"Local {gender} Voice - {locale}",
+                'Locale': locale,
+                'Gender': gender,
+            }
+            for short_name, locale, gender, _ in self.VOICES
+        ]
+
+    def capabilities(self):
+        return dict(super().capabilities(), boundaries=True)
+
+
+# 可选的语音合成后端
+TTS_BACKENDS = {
+    EdgeTTSBackend.name: EdgeTTSBackend,
+    LocalTTSBackend.name: LocalTTSBackend,
+}
+DEFAULT_TTS_BACKEND = EdgeTTSBackend.name
+
+
+def create_tts_backend(name=DEFAULT_TTS_BACKEND, **options):
+    """按名称创建语音合成后端"""
+    try:
+        return TTS_BACKENDS[name](**options)
+    except KeyError:
+        raise ValueError(f"未知的语音合成后端: {name}")
+
+
+# 语音列表缓存的有效期（秒）
+VOICE_CATALOG_TTL = 7 * 24 * 3600
+
+
+class VoiceCatalog:
+    """可用语音列表，带磁盘缓存以及按地区、性别和 ShortName 的索引
+
+    启动时只读取本地缓存，不访问网络；缓存过期或不存在时再调用 refresh()
+    从后端重新获取。
+    """
+
+    def __init__(self, backend=None, cache_file=None, ttl=VOICE_CATALOG_TTL):
+        self.backend = backend or create_tts_backend()
+        self.cache_file = cache_file or os.path.join(
+            get_cache_dir(), f"voices_{self.backend.name}.json"
+        )
+        self.ttl = ttl
+        self.fetched_at = None
+        self._index([])
+
+    def _index(self, voices):
+        self.voices = voices
+        self.by_short_name = {}
+        self.by_locale = {}
+        self.by_language = {}
+        self.by_gender = {}
+        for v in voices:
+            short_name = v.get('ShortName')
+            locale = v.get('Locale', '')
+            if not short_name:
+                continue
+            self.by_short_name[short_name] = v
+            self.by_locale.setdefault(locale.lower(), []).append(v)
+            self.by_language.setdefault(locale.split('-')[0].lower(), []).append(v)
+            self.by_gender.setdefault(v.get('Gender', '').lower(), []).append(v)
+
+    def load_cached(self):
+        """读取磁盘缓存（即使已过期），成功时返回 True"""
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != self.backend.version:
+                return False
+            self._index(data['voices'])
+            self.fetched_at = data['fetched_at']
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    @property
+    def is_stale(self):
+        """没有缓存或缓存已超过有效期"""
+        return self.fetched_at is None or time.time() - self.fetched_at > self.ttl
+
+    async def refresh(self):
+        """从后端获取最新的语音列表并写入缓存"""
+        voices = await self.backend.list_voices()
+        self._index(voices)
+        self.fetched_at = time.time()
+
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'version': self.backend.version,
+                    'fetched_at': self.fetched_at,
+                    'voices': voices,
+                }, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_file)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return voices
+
+    async def ensure_loaded(self):
+        """优先使用未过期的缓存，否则重新获取；离线时退回过期的缓存"""
+        cached = self.load_cached()
+        if cached and not self.is_stale:
+            return self.voices
+        try:
+            return await self.refresh()
+        except Exception:
+            if cached:
+                return self.voices
+            raise
+
+    def get(self, short_name):
+        """按 ShortName 查找语音"""
+        return self.by_short_name.get(short_name)
+
+    def find(self, locale=None, gender=None):
+        """按地区和性别筛选语音，locale 可以是 "zh-CN" 或语言代码 "zh"
+
+        两个条件都给出时取两个索引中较小的一个，只检查其中的语音是否也在
+        另一个里，结果保持语音列表原来的顺序。
+        """
+        buckets = []
+        if locale:
+            key = locale.lower()
+            index = self.by_locale if '-' in key else self.by_language
+            buckets.append(index.get(key, []))
+        if gender:
+            buckets.append(self.by_gender.get(gender.lower(), []))
+        if not buckets:
+            return self.voices
+        if len(buckets) == 1:
+            return buckets[0]
+        smaller, larger = sorted(buckets, key=len)
+        members = {id(v) for v in larger}
+        return [v for v in smaller if id(v) in members]
+
+
+# 语音片段缓存的默认容量上限（字节）
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def get_cache_dir():
+    """获取用户级缓存目录"""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'subtitle_to_speech')
+
+
+def write_file_atomic(path, data):
+    """先写入同目录下的临时文件再替换，中断时不会留下半个文件"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def segment_cache_key(text, voice, rate, volume, backend_version=None):
+    """根据合成参数计算语音片段的内容地址"""
+    if backend_version is None:
+        backend_version = EdgeTTSBackend.version
+    payload = json.dumps([text, voice, rate, volume, backend_version], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SegmentCache:
+    """按内容寻址的语音片段磁盘缓存，超出容量时按最近使用时间淘汰"""
+
+    # 缓存中允许出现的音频扩展名
+    SUFFIXES = ('.mp3', '.wav')
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir or os.path.join(get_cache_dir(), "segments")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def get(self, key, suffix=".mp3"):
+        """返回缓存文件路径，未命中时返回 None；suffix 可以是几个候选扩展名的元组"""
+        suffixes = (suffix,) if isinstance(suffix, str) else suffix
+        with self._lock:
+            for candidate in suffixes:
+                path = self._path(key, candidate)
+                try:
+                    # 更新访问时间，作为 LRU 淘汰的依据
+                    os.utime(path)
+                except OSError:
+                    continue
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def contains(self, key, suffix=".mp3"):
+        """是否有缓存，不计入命中统计"""
+        suffixes = (suffix,) if isinstance(suffix, str) else suffix
+        return any(os.path.exists(self._path(key, candidate)) for candidate in suffixes)
+
+    def read(self, key, suffix=".mp3"):
+        """返回缓存的音频数据，未命中时返回 None"""
+        path = self.get(key, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            # 刚好被其他进程淘汰
+            return None
+
+    def put(self, key, source_file):
+        """将合成好的文件原子地写入缓存，返回缓存文件路径"""
+        with open(source_file, 'rb') as f:
+            return self.put_data(key, f.read(), os.path.splitext(source_file)[1])
+
+    def put_data(self, key, data, suffix=".mp3"):
+        """将音频数据原子地写入缓存，返回缓存文件路径"""
+        path = self._path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, data)
+
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = self._scan_size()
+            else:
+                self._total_size += os.path.getsize(path)
+            if self._total_size > self.max_size:
+                self._evict()
+        return path
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(self.SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """删除最久未使用的片段，直到缓存回落到容量的 90%"""
+        target = self.max_size * 0.9
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        self._total_size = total
+
+    def stats_text(self):
+        """返回用于日志的命中统计"""
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups * 100 if lookups else 0
+        return f"缓存命中 {self.hits} 次，未命中 {self.misses} 次 (命中率 {ratio:.1f}%)"
+
+
+# 命令行模式的默认语音
+DEFAULT_VOICE = "zh-CN-XiaoxiaoNeural"
+
+# 视为视频的文件扩展名
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov')
+
+
+class ConversionError(Exception):
+    """转换流程中可以直接展示给用户的错误"""
+
+
+def peak_rss_bytes():
+    """当前进程的峰值常驻内存（字节），无法获取时返回 None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 以 KB 为单位，macOS 以字节为单位
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', None) or info.rss
+    except ImportError:
+        return None
+
+
+class PipelineMetrics:
+    """记录一次转换各阶段的耗时、语音合成延迟、数据量和缓存命中情况
+
+    stage() 统计的是墙钟时间，同一阶段多次进入时累加。结果可以写成
+    JSON 或 CSV，便于比较不同版本和估算渲染机器的配置。
+    """
+
+    STAGE_NAMES = {
+        'parse': "解析字幕",
+        'synthesis': "语音合成",
+        'decode': "解码语音",
+        'resynthesis': "重新合成",
+        'time_fit': "时长调整",
+        'decode_background': "解码原始音频",
+        'mix': "混音",
+        'encode': "编码封装",
+    }
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tts_latencies = []
+        self.counters = {}
+        self.info = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_tts_latency(self, seconds):
+        self.tts_latencies.append(seconds)
+
+    def count(self, name, value=1):
+        """累加计数，例如数据量 (bytes_*) 或进程数"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def latency_percentiles(self):
+        if not self.tts_latencies:
+            return {}
+        p50, p95, p99 = np.percentile(self.tts_latencies, [50, 95, 99])
+        return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+                'count': len(self.tts_latencies)}
+
+    def to_dict(self):
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'stages': dict(self.stages),
+            'tts_latency': self.latency_percentiles(),
+            'counters': dict(self.counters),
+            'peak_rss_bytes': peak_rss_bytes(),
+            **self.info,
+        }
+
+    def write(self, path):
+        """按扩展名写成 JSON 或 CSV (metric,value 两列)"""
+        data = self.to_dict()
+        if path.lower().endswith('.csv'):
+            rows = [('total_seconds', data['total_seconds']),
+                    ('peak_rss_bytes', data['peak_rss_bytes'])]
+            rows += [(f"stage.{k}", v) for k, v in data['stages'].items()]
+            rows += [(f"tts_latency.{k}", v) for k, v in data['tts_latency'].items()]
+            rows += [(f"counter.{k}", v) for k, v in data['counters'].items()]
+            rows += [(k, v) for k, v in self.info.items()]
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['metric', 'value'])
+                writer.writerows(rows)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def summary_lines(self):
+        """用于日志的简要统计"""
+        lines = []
+        for name, seconds in self.stages.items():
+            lines.append(f"  {self.STAGE_NAMES.get(name, name)}: {seconds:.2f}秒")
+        latency = self.latency_percentiles()
+        if latency:
+            lines.append(
+                f"  单句合成延迟: p50 {latency['p50']:.2f}秒 / p95 {latency['p95']:.2f}秒 "
+                f"/ p99 {latency['p99']:.2f}秒"
+            )
+        peak = peak_rss_bytes()
+        if peak:
+            lines.append(f"  峰值内存: {peak / 1024 / 1024:.0f} MB")
+        return lines
+
+
+@contextlib.contextmanager
+def profiling(profile_path=None, trace_memory=False, log=print):
+    """可选的 cProfile / tracemalloc 分析
+
+    profile_path 不为空时把 cProfile 结果保存到该文件（可用 pstats 或
+    snakeviz 查看）；trace_memory 为 True 时结束后输出分配最多的代码行。
+    """
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            log(f"性能分析结果已保存: {profile_path}")
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            log(f"Python 内存分配峰值: {peak / 1024 / 1024:.1f} MB")
+            for stat in snapshot.statistics('lineno')[:10]:
+                log(f"  {stat}")
+
+
+async def synthesize_text(text, voice, rate, volume, throttle=None, backend=None,
+                          boundaries=False, log=print):
+    """合成一句文本并返回音频数据，失败时按退避策略重试
+
+    连接断开引起的第一次失败立即重试（后端会换一条新连接）；其他错误按
+    指数退避等待，延迟乘以 0.5~1 的随机系数，避免大量请求同时重试。
+    boundaries 为 True 时返回 backend.synthesize_with_boundaries() 的结果。
+    重试和限流的提示通过 log 输出。
+    """
+    backend = backend or create_tts_backend()
+    max_retries = TTS_MAX_RETRIES
+
+    for attempt in range(max_retries):
+        if throttle:
+            await throttle.wait()
+        try:
+            if boundaries:
+                data = await backend.synthesize_with_boundaries(text, voice, rate, volume)
+            else:
+                data = await backend.synthesize(text, voice, rate, volume)
+            if throttle:
+                throttle.on_success()
+            return data  # 成功则直接返回
+
+        except Exception as e:
+            if attempt < max_retries - 1:  # 如果还有重试机会
+                if throttle and is_throttle_error(e):
+                    # 服务限流时由共享状态统一退避
+                    delay = throttle.on_throttled()
+                    log(f"语音服务限流，所有任务暂停{delay:.0f}秒: {str(e)}")
+                    continue
+                if attempt == 0 and is_connection_error(e):
+                    log(f"语音服务连接断开，重新连接: {str(e)}")
+                    continue
+                delay = (min(TTS_RETRY_MAX_DELAY, TTS_RETRY_BASE_DELAY * 2 ** attempt)
+                         * random.uniform(0.5, 1.0))
+                log(f"语音生成失败{delay:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(delay)
+            else:  # 最后一次尝试失败
+                raise  # 重新抛出异常
+
+
+def normalize_line_text(line):
+    """字幕的朗读文本：去掉 ASS 特效标签，换行 (\\N) 和连续空白合并为一个空格"""
+    return " ".join(line.plaintext.split())
+
+
+# 合并合成时一次请求的最多字数
+GROUP_MAX_CHARS = 400
+# 切分合并合成的音频时，每段在首尾词之外最多保留的静音（毫秒）
+GROUP_SPLIT_PADDING_MS = 50
+
+
+def join_group_text(texts):
+    """把几条字幕连成一次合成请求的文本，返回 (文本, 各条在文本中的字符范围)
+
+    没有结尾标点的字幕补一个句号，让相邻字幕之间有停顿，便于切分。
+    """
+    parts = []
+    ranges = []
+    position = 0
+    for text in texts:
+        if not unicodedata.category(text[-1]).startswith('P'):
+            text += "。" if ord(text[-1]) >= 0x2e80 else "."
+        parts.append(text)
+        ranges.append((position, position + len(text)))
+        position += len(text) + 1
+    return " ".join(parts), ranges
+
+
+def split_group_audio(samples, sample_rate, boundaries, text, ranges):
+    """按词边界把合并合成的音频切回各条字幕，返回与 ranges 对应的采样列表
+
+    boundaries 为 [(开始秒数, 持续秒数, 词)]，按顺序在 text 中查找每个词
+    得到它属于哪条字幕。相邻两条在前一条末词与后一条首词之间的停顿中点
+    切开，每段在首尾词之外最多保留 GROUP_SPLIT_PADDING_MS 的静音。某条
+    字幕没有对应的词时抛出 ConversionError。
+    """
+    starts = [start for start, _ in ranges]
+    spans = [None] * len(ranges)
+    cursor = 0
+    for offset, duration, word in boundaries:
+        position = text.find(word, cursor) if word else -1
+        if position < 0:
+            continue
+        cursor = position + len(word)
+        n = bisect.bisect_right(starts, position) - 1
+        if n < 0 or position >= ranges[n][1]:
+            continue
+        first, last = spans[n] or (offset, offset + duration)
+        spans[n] = (min(first, offset), max(last, offset + duration))
+    if None in spans:
+        raise ConversionError("合并合成的词边界与字幕对不上")
+
+    padding = GROUP_SPLIT_PADDING_MS / 1000
+    cuts = [0.0] + [(spans[n][1] + spans[n + 1][0]) / 2 for n in range(len(spans) - 1)]
+    cuts.append(len(samples) / sample_rate)
+    pieces = []
+    for n, (first, last) in enumerate(spans):
+        begin = max(cuts[n], first - padding)
+        end = max(begin, min(cuts[n + 1], last + padding))
+        pieces.append(samples[round(begin * sample_rate):round(end * sample_rate)])
+    return pieces
+
+
+def schedule_synthesis(lines, voice, rate, volume, concurrency,
+                       cache=None, progress=None, limiter=None, throttle=None,
+                       backend=None, metrics=None, decoder=None, group_cues=0, log=print):
+    """在当前事件循环中启动字幕语音的并发合成，返回与 lines 顺序一致的任务列表
+
+    lines 的每项为 (下标, 文本) 或 (下标, 文本, 语速)，后者覆盖统一的 rate。
+    任务的结果为音频数据 (bytes)；传入 decoder (DecoderPool) 时每段合成完
+    立即开始解码，结果是解码任务的 Future。文本和语速都相同的字幕只合成
+    一次，共享同一个任务。批量处理时可以传入多个文件共享的 limiter 和
+    throttle，让所有文件共用同一个并发上限。
+
+    group_cues 大于 1 且后端支持词边界时，最多这么多条相邻的、没有缓存的
+    字幕合成为一次请求，再用 split_group_audio 切回各条（切好的片段以 WAV
+    缓存）。合并请求失败或切分不成功时这几条改为逐条合成。重试、缓存写入
+    失败等提示通过 log 输出。
+    """
+    semaphore = limiter or asyncio.Semaphore(max(1, concurrency))
+    throttle = throttle or TTSThrottle()
+    backend = backend or create_tts_backend(pool_size=concurrency)
+    finished = 0
+    # 合并合成切出的片段以 WAV 缓存
+    suffixes = tuple(dict.fromkeys((backend.suffix, ".wav")))
+
+    keys = [
+        segment_cache_key(line[1], voice, line[2] if len(line) > 2 else rate, volume,
+                          backend.version)
+        for line in lines
+    ]
+    total = len(set(keys))
+
+    def done():
+        nonlocal finished
+        finished += 1
+        if progress:
+            progress(finished / total * 100)
+
+    def store(key, data, suffix):
+        if cache:
+            try:
+                cache.put_data(key, data, suffix)
+            except OSError as e:
+                log(f"写入语音缓存失败: {str(e)}")
+        return decoder.submit(data, metrics) if decoder else data
+
+    async def synthesize(key, index, text, line_rate=rate):
+        try:
+            # 相同参数合成过的文本直接使用缓存
+            data = cache.read(key, suffixes) if cache else None
+            if data is not None:
+                return decoder.submit(data, metrics) if decoder else data
+            async with semaphore:
+                request_start = time.perf_counter()
+                data = await synthesize_text(text, voice, line_rate, volume, throttle,
+                                             backend, log=log)
+                if metrics:
+                    metrics.record_tts_latency(time.perf_counter() - request_start)
+                    metrics.count('bytes_tts_audio', len(data))
+            return store(key, data, backend.suffix)
+        finally:
+            done()
+
+    async def synthesize_group(texts, line_rate):
+        """合成一组字幕，返回各条的 WAV 数据，失败时返回 None"""
+        text, ranges = join_group_text(texts)
+        try:
+            async with semaphore:
+                request_start = time.perf_counter()
+                data, boundaries = await synthesize_text(text, voice, line_rate, volume,
+                                                         throttle, backend, boundaries=True,
+                                                         log=log)
+                if metrics:
+                    metrics.record_tts_latency(time.perf_counter() - request_start)
+                    metrics.count('bytes_tts_audio', len(data))
+            samples = await asyncio.get_running_loop().run_in_executor(
+                None, decode_audio_data, data, DUB_SAMPLE_RATE
+            )
+            pieces = split_group_audio(samples, DUB_SAMPLE_RATE, boundaries, text, ranges)
+        except Exception as e:
+            log(f"⚠️ {len(texts)} 条字幕合并合成失败，改为逐条合成: {str(e)}")
+            return None
+        if metrics:
+            metrics.count('grouped_requests')
+            metrics.count('grouped_cues', len(texts))
+        return [encode_wav(piece, DUB_SAMPLE_RATE) for piece in pieces]
+
+    async def synthesize_in_group(key, text, line_rate, group, position):
+        outputs = await group
+        if outputs is None:
+            return await synthesize(key, None, text, line_rate)
+        try:
+            return store(key, outputs[position], ".wav")
+        finally:
+            done()
+
+    # 相邻的、语速相同且没有缓存的字幕分为一组
+    groups = []
+    if group_cues > 1 and backend.capabilities().get('boundaries'):
+        seen = set()
+        current = []
+        for key, line in zip(keys, lines):
+            if key in seen:
+                continue
+            seen.add(key)
+            line_rate = line[2] if len(line) > 2 else rate
+            if cache and cache.contains(key, suffixes):
+                continue
+            chars = sum(len(text) for _, text, _ in current) + len(line[1])
+            if current and (len(current) >= group_cues or current[0][2] != line_rate
+                            or chars > GROUP_MAX_CHARS):
+                groups.append(current)
+                current = []
+            current.append((key, line[1], line_rate))
+        groups.append(current)
+
+    tasks = {}
+    for group in groups:
+        if len(group) < 2:
+            continue
+        group_task = asyncio.ensure_future(
+            synthesize_group([text for _, text, _ in group], group[0][2])
+        )
+        for position, (key, text, line_rate) in enumerate(group):
+            tasks[key] = asyncio.ensure_future(
+                synthesize_in_group(key, text, line_rate, group_task, position)
+            )
+    for key, line in zip(keys, lines):
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(synthesize(key, *line))
+    return [tasks[key] for key in keys]
+
+
+async def synthesize_lines(lines, voice, rate, volume, concurrency, **options):
+    """并发合成字幕语音，等待全部完成后返回与输入顺序一致的结果列表
+
+    参数与 schedule_synthesis 相同，失败的字幕对应的结果为异常对象。
+    """
+    tasks = schedule_synthesis(lines, voice, rate, volume, concurrency, **options)
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_output_path(subtitle_path, media_path=None):
+    """计算转换结果的保存路径（原始文件所在目录）"""
+    # 没有媒体文件时使用字幕文件名
+    input_name = os.path.splitext(media_path or subtitle_path)[0]
+    if media_path and media_path.lower().endswith(VIDEO_EXTENSIONS):
+        return f"{input_name}_s.mp4"
+    return f"{input_name}_s.mp3"
+
+
+def is_output_up_to_date(subtitle_path, media_path=None):
+    """输出文件已存在且比输入文件新时视为已完成
+
+    任务目录还在时（中断或有字幕失败）视为未完成。
+    """
+    output = get_output_path(subtitle_path, media_path)
+    if os.path.isdir(get_job_dir(subtitle_path, media_path)):
+        return False
+    try:
+        output_mtime = os.path.getmtime(output)
+        inputs = [subtitle_path] + ([media_path] if media_path else [])
+        return all(os.path.getmtime(path) <= output_mtime for path in inputs)
+    except OSError:
+        return False
+
+
+# 配音时间轴的采样格式，与 edge-tts 输出一致，避免重采样
+DUB_SAMPLE_RATE = 24000
+DUB_CHANNELS = 1
+
+# 配音片段互相重叠时，先写入的部分降低的音量 (dB)
+OVERLAP_GAIN_DB = -1
+
+
+def db_to_gain(db):
+    """分贝转换为线性增益"""
+    return 10 ** (db / 20)
+
+
+def audio_segment_to_array(segment, sample_rate=DUB_SAMPLE_RATE, channels=DUB_CHANNELS):
+    """将 AudioSegment 转换为形状为 (帧数, 声道数) 的 int16 数组"""
+    segment = segment.set_frame_rate(sample_rate).set_channels(channels).set_sample_width(2)
+    return np.frombuffer(segment.raw_data, dtype=np.int16).reshape(-1, channels)
+
+
+def overlay_samples(buffer, offset, samples, gain_during_overlay=0):
+    """把 samples 叠加到 buffer 的 offset 处，超出缓冲区的部分被忽略
+
+    与 AudioSegment.overlay 相同，被覆盖的已有内容先降低
+    gain_during_overlay 分贝，再与新片段相加并限幅。offset 可以为负数，
+    用于把片段的一部分写入分块的窗口中。
+    """
+    src_start = max(0, -offset)
+    dst_start = max(0, offset)
+    length = min(len(samples) - src_start, len(buffer) - dst_start)
+    if length <= 0:
+        return
+    region = buffer[dst_start:dst_start + length]
+    mixed = region.astype(np.float32)
+    if gain_during_overlay:
+        mixed *= db_to_gain(gain_during_overlay)
+    mixed += samples[src_start:src_start + length]
+    np.clip(mixed, -32768, 32767, out=mixed)
+    region[:] = mixed
+
+
+# 最终输出的采样格式
+OUTPUT_SAMPLE_RATE = 44100
+OUTPUT_CHANNELS = 2
+
+# 流式混音每次处理的时长（秒）
+STREAM_WINDOW_SECONDS = 10
+
+# 背景音频预先解码的窗口数
+BACKGROUND_PREFETCH_WINDOWS = 3
+
+
+# 片段存储区初始容量（帧）
+ARENA_INITIAL_FRAMES = 60 * OUTPUT_SAMPLE_RATE
+
+
+class SegmentArena:
+    """首尾相接保存语音采样的内存映射 PCM 文件
+
+    采样写入缓存目录下的临时文件，通过内存映射读写，用过的页面由 release()
+    交还给系统，内存占用不随配音总时长增长。write() 返回偏移，read() 返回
+    直接引用映射内存的视图，不复制。clear() 后保留文件和映射供下一次转换
+    复用，容量不够时按两倍扩大。可以在多个线程中同时写入和读取。
+    """
+
+    def __init__(self, capacity=ARENA_INITIAL_FRAMES):
+        arena_dir = get_cache_dir()
+        os.makedirs(arena_dir, exist_ok=True)
+        self._file = tempfile.TemporaryFile(dir=arena_dir, prefix="arena_", suffix=".pcm")
+        self._lock = threading.Lock()
+        self._map = None
+        self._data = None
+        self.used = 0
+        self._reserve(max(1, capacity))
+
+    def _reserve(self, frames):
+        """保证映射至少有 frames 帧，已返回的视图仍然有效"""
+        if self._data is not None and len(self._data) >= frames:
+            return
+        capacity = max(frames, 2 * len(self._data)) if self._data is not None else frames
+        # 先把文件扩大到新的容量再映射，旧的映射在所有视图释放后自动关闭
+        self._file.seek(capacity * 2 - 1)
+        self._file.write(b"\0")
+        self._file.flush()
+        self._map = mmap.mmap(self._file.fileno(), capacity * 2)
+        self._data = np.frombuffer(self._map, dtype=np.int16)
+
+    def write(self, samples):
+        """把 int16 采样追加到末尾，返回起始偏移（帧）"""
+        samples = samples.reshape(-1)
+        with self._lock:
+            offset = self.used
+            self._reserve(offset + len(samples))
+            self.used += len(samples)
+            data = self._data
+        data[offset:offset + len(samples)] = samples
+        return offset
+
+    def read(self, offset, length):
+        """从 offset 开始的 length 帧"""
+        return self._data[offset:offset + length]
+
+    def release(self):
+        """让系统收回读写过的映射页面，数据仍保留在文件中，再次访问时重新读入
+
+        不支持 madvise 的平台（Windows）由系统在内存紧张时自行回收。
+        """
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            with self._lock:
+                if self.used:
+                    self._map.madvise(mmap.MADV_DONTNEED, 0, self.used * 2)
+
+    def clear(self):
+        """丢弃所有采样，保留已分配的空间，之前返回的视图不再有效"""
+        self.release()
+        with self._lock:
+            self.used = 0
+
+    def close(self):
+        with self._lock:
+            self._data = None
+            self._map = None
+            self._file.close()
+
+
+class DubTimeline:
+    """按开始时间排序的配音片段，按需渲染任意一段时间窗口
+
+    片段的采样保存在 SegmentArena 中，每个片段在 index 中占一行
+    (叠加顺序, 开始帧, 偏移, 帧数)。不生成整条配音音轨，流式混音时内存
+    占用与影片和配音的长度都无关。arena 可以与其他时间线共用，不传入时
+    使用自己的存储区。
+    """
+
+    INDEX_DTYPE = np.dtype([('order', np.int64), ('start', np.int64),
+                            ('offset', np.int64), ('length', np.int64)])
+
+    def __init__(self, sample_rate=OUTPUT_SAMPLE_RATE, arena=None):
+        self.sample_rate = sample_rate
+        self.arena = arena or SegmentArena()
+        self.index = np.zeros(256, dtype=self.INDEX_DTYPE)
+        self.count = 0
+        self.end_frame = 0
+        self.max_length = 0
+        self._sorted = None
+
+    def ms_to_frames(self, ms):
+        return int(round(ms * self.sample_rate / 1000))
+
+    def add(self, samples, start_ms, order=None):
+        """加入一维 int16 单声道采样
+
+        order 为叠加顺序（例如字幕下标），默认按加入的先后顺序。
+        """
+        start = self.ms_to_frames(start_ms)
+        if self.count == len(self.index):
+            self.index = np.resize(self.index, 2 * len(self.index))
+        self.index[self.count] = (self.count if order is None else order, start,
+                                  self.arena.write(samples), samples.size)
+        self.count += 1
+        self.end_frame = max(self.end_frame, start + samples.size)
+        self.max_length = max(self.max_length, samples.size)
+        self._sorted = None
+
+    def _find(self, start, end):
+        """二分查找与 [start, end) 相交的片段，按叠加顺序返回 index 中的行号"""
+        index = self.index[:self.count]
+        if self._sorted is None:
+            order = np.argsort(index['start'], kind='stable')
+            self._sorted = (order, index['start'][order])
+        order, starts = self._sorted
+        lo = np.searchsorted(starts, start - self.max_length, side='right')
+        hi = np.searchsorted(starts, end, side='left')
+        found = order[lo:hi]
+        found = found[index['start'][found] + index['length'][found] > start]
+        return found[np.argsort(index['order'][found], kind='stable')]
+
+    def speech_ranges(self, start, end):
+        """与 [start, end) 相交的片段的 (开始帧, 结束帧)，按开始时间排序"""
+        rows = self.index[self._find(start, end)]
+        return sorted(zip(rows['start'].tolist(), (rows['start'] + rows['length']).tolist()))
+
+    def wait(self, end):
+        """流式混音渲染到 end 帧之前调用，片段全部预先加入时无需等待"""
+
+    def render(self, start, frames):
+        """渲染 [start, start + frames) 区间的配音，返回 (帧数, 1) 的 int16 数组
+
+        按片段的叠加顺序叠加，与整条音轨一次性混音的结果一致。
+        """
+        window = np.zeros((frames, 1), dtype=np.int16)
+        for seg_start, offset, length in self.index[self._find(start, start + frames)][
+                ['start', 'offset', 'length']].tolist():
+            overlay_samples(window, seg_start - start,
+                            self.arena.read(offset, length).reshape(-1, 1), OVERLAP_GAIN_DB)
+        # 混音按窗口推进，已经用过的片段不必常驻内存
+        self.arena.release()
+        return window
+
+
+class StreamingTimeline(DubTimeline):
+    """边合成边混音的配音时间线
+
+    slots 为 schedule_cues 排布好的时间段 {下标: slot}。各段语音解码后用
+    ready() 交给时间线（失败时调用 failed()），流式混音渲染一个窗口前由
+    wait() 等待所有开始于窗口结束之前的时间段，再把已就绪的片段调整时长
+    后加入。混音按时间顺序推进，只需等待当前窗口内的字幕，语音合成、
+    解码、时长调整和编码可以同时进行。等待混音的语音也暂存在 arena 中，
+    合成比混音快很多时内存占用同样不会增长。
+    """
+
+    # 调整时长时一并处理窗口之后这段时间（秒）内已就绪的字幕，凑成较大的批次
+    LOOKAHEAD_SECONDS = 60
+
+    def __init__(self, slots, stretcher, metrics=None, arena=None):
+        super().__init__(arena=arena)
+        self.slots = slots
+        self.stretcher = stretcher
+        self.metrics = metrics or PipelineMetrics()
+        self.failures = {}  # {下标: 异常}
+        self.placed = 0
+        self._waiting = set(slots)
+        self._order = sorted((self.ms_to_frames(slot['start']), i) for i, slot in slots.items())
+        self._next = 0
+        self._ready = {}  # {下标: (文本, arena 中的偏移, 帧数)}
+        self._cancelled = False
+        self._condition = threading.Condition()
+
+        # 按排布的可用时长算出总长度，配音结束后保留一秒。超过 MAX_STRETCH_SPEED
+        # 仍放不下、延续到最后一段之后的语音会被截断
+        ends = [
+            self.ms_to_frames(slot['start']) + self.ms_to_frames(slot['limit'] - slot['start'])
+            for slot in slots.values()
+        ]
+        self.total_frames = max(ends, default=0) + self.sample_rate
+
+    def ready(self, index, text, samples):
+        """一条字幕的语音已解码"""
+        offset = self.arena.write(samples)
+        self.arena.release()
+        with self._condition:
+            self._waiting.discard(index)
+            self._ready[index] = (text, offset, samples.size)
+            self._condition.notify_all()
+
+    def failed(self, index, error):
+        """一条字幕转换失败，混音时跳过"""
+        with self._condition:
+            self._waiting.discard(index)
+            self.failures[index] = error
+            self._condition.notify_all()
+
+    def cancel(self):
+        """中止混音，正在等待的 wait() 抛出 ConversionError"""
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def _take(self, ready):
+        """把暂存的语音换成 {下标: (文本, 采样)}"""
+        return {i: (text, self.arena.read(offset, length))
+                for i, (text, offset, length) in ready.items()}
+
+    def drain(self):
+        """取出所有已就绪但尚未加入时间线的片段"""
+        with self._condition:
+            ready, self._ready = self._ready, {}
+        return self._take(ready)
+
+    def wait(self, end):
+        with self._condition:
+            while True:
+                if self._cancelled:
+                    raise ConversionError("转换已取消")
+                while (self._next < len(self._order)
+                       and self._order[self._next][1] not in self._waiting):
+                    self._next += 1
+                if self._next == len(self._order) or self._order[self._next][0] >= end:
+                    break
+                self._condition.wait()
+
+            horizon = end + self.LOOKAHEAD_SECONDS * self.sample_rate
+            batch = {
+                i: value for i, value in self._ready.items()
+                if self.ms_to_frames(self.slots[i]['start']) < horizon
+            }
+            for i in batch:
+                del self._ready[i]
+
+        if batch:
+            with self.metrics.stage('time_fit'):
+                segments = fit_segments(self.slots, self._take(batch), self.stretcher)
+            for segment in segments:
+                self.add(segment['samples'], segment['start'], order=segment['index'])
+            self.placed += len(segments)
+
+
+def read_exact(stream, size):
+    """从管道读取 size 字节，流结束时返回实际读到的数据"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def open_pcm_decoder(audio_path, loop=True, start=0, sample_rate=OUTPUT_SAMPLE_RATE,
+                     channels=OUTPUT_CHANNELS):
+    """启动ffmpeg把音频解码为 s16le PCM 输出到管道
+
+    loop 为 True 时循环播放输入，背景音频比配音短时自动重复。start 为
+    开始解码的位置（秒）。audio_path 为 "pipe:0" 时从 stdin 读取，收到
+    开头几个字节就开始输出，适合边合成边播放。错误输出写入临时文件
+    (error_log)，不会因为没人读取而阻塞，解码提前结束时用
+    check_pcm_decoder() 检查。
+    """
+    command = ['ffmpeg', '-loglevel', 'error']
+    if loop:
+        command += ['-stream_loop', '-1']
+    if start:
+        command += ['-ss', f"{start:.6f}"]
+    if audio_path == 'pipe:0':
+        # 不等待凑满默认的探测数据量
+        command += ['-probesize', '32']
+    command += [
+        '-i', audio_path,
+        '-vn',
+        '-f', 's16le',
+        '-ac', str(channels),
+        '-ar', str(sample_rate),
+        'pipe:1'
+    ]
+    error_log = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if audio_path == 'pipe:0' else None,
+        stdout=subprocess.PIPE,
+        stderr=error_log
+    )
+    process.error_log = error_log
+    return process
+
+
+def check_pcm_decoder(decoder, received):
+    """解码输出提前结束时调用，received 为已读到的字节数
+
+    ffmpeg 出错退出或一个字节都没有输出（文件不存在、损坏或没有音轨）时
+    抛出 ConversionError；正常结束时（例如输入无法循环）不做处理。
+    """
+    returncode = decoder.wait()
+    if returncode != 0 or not received:
+        decoder.error_log.seek(0)
+        message = decoder.error_log.read().decode(errors='replace').strip()
+        raise ConversionError(f"解码原始音频失败: {message or f'ffmpeg 返回 {returncode}'}")
+
+
+def open_pcm_encoder(output_args, input_args=()):
+    """启动ffmpeg从管道读取 s16le PCM 并编码
+
+    input_args 为排在管道之前的其他输入（例如原视频），output_args 为输出
+    相关参数，可以包含多个输出文件。
+    """
+    command = [
+        'ffmpeg', '-loglevel', 'error',
+        *input_args,
+        '-f', 's16le',
+        '-ac', str(OUTPUT_CHANNELS),
+        '-ar', str(OUTPUT_SAMPLE_RATE),
+        '-i', 'pipe:0'
+    ] + output_args
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def volume_to_gain(volume):
+    """原始音频音量百分比 (0-100) 对应的线性增益"""
+    return db_to_gain(-20 * (1 - volume / 100.0))
+
+
+# 背景闪避在对白开始前压低、结束后恢复所用的时间（毫秒）
+DUCK_ATTACK_MS = 150
+DUCK_RELEASE_MS = 400
+
+
+class BackgroundDucker:
+    """按配音的位置压低背景音频（侧链闪避）
+
+    对白期间背景音量为 bg_volume，对白之间恢复为 gap_volume。增益在对白
+    开始前 attack_ms 内线性降低、结束后 release_ms 内线性恢复，间隔不足
+    attack_ms + release_ms 的对白视为连续。apply() 对一个窗口的采样整块
+    计算，只依赖窗口前后 margin 帧内的片段，分块渲染的结果与整条音轨
+    一次渲染一致。
+    """
+
+    def __init__(self, bg_volume, gap_volume, attack_ms=DUCK_ATTACK_MS,
+                 release_ms=DUCK_RELEASE_MS, sample_rate=OUTPUT_SAMPLE_RATE):
+        self.duck_gain = volume_to_gain(bg_volume)
+        self.open_gain = volume_to_gain(gap_volume)
+        self.attack = int(attack_ms * sample_rate / 1000)
+        self.release = int(release_ms * sample_rate / 1000)
+        self.margin = self.attack + self.release
+
+    def settings(self):
+        """影响混音结果的参数"""
+        return [self.duck_gain, self.open_gain, self.attack, self.release]
+
+    def apply(self, timeline, start, samples):
+        """把从第 start 帧开始的闪避增益原地乘到背景采样 samples (帧数, 声道数) 上"""
+        end = start + len(samples)
+        runs = []
+        for a, b in timeline.speech_ranges(start - self.margin, end + self.margin):
+            if runs and a - runs[-1][1] < self.margin:
+                runs[-1][1] = max(runs[-1][1], b)
+            else:
+                runs.append([a, b])
+        if any(a <= start and b >= end for a, b in runs):
+            samples *= self.duck_gain
+            return
+
+        # 整个窗口先乘对白间的增益，再只对对白期间和两端的斜坡补乘比例，
+        # 开销与乘一个固定增益相当
+        samples *= self.open_gain
+        ratio = self.duck_gain / self.open_gain
+        for a, b in runs:
+            for lo, hi, first, last in ((a - self.attack, a, 1.0, ratio),
+                                        (b, b + self.release, ratio, 1.0)):
+                lo_clip, hi_clip = max(lo, start), min(hi, end)
+                if lo_clip < hi_clip:
+                    ramp = np.arange(lo_clip - lo, hi_clip - lo, dtype=np.float32) / (hi - lo)
+                    samples[lo_clip - start:hi_clip - start] *= (first + (last - first) * ramp)[:, None]
+            if max(a, start) < min(b, end):
+                samples[max(a, start) - start:min(b, end) - start] *= ratio
+
+
+def mix_window(dub, background=None, bg_volume=100, duck=None):
+    """把 (帧数, 1) 的配音叠加到按 bg_volume 衰减的背景音频上，返回 s16le 字节
+
+    background 比配音短（背景音频读完或解码失败）时其余部分保持静音。
+    duck 为原地调整背景采样的函数（见 BackgroundDucker.apply），给出时
+    代替 bg_volume。
+    """
+    mixed = np.zeros((len(dub), OUTPUT_CHANNELS), dtype=np.float32)
+    if background is not None:
+        mixed[:len(background)] = background
+        if duck:
+            duck(mixed)
+        else:
+            mixed *= volume_to_gain(bg_volume)
+    # 单声道配音叠加到所有声道
+    mixed += dub
+    np.clip(mixed, -32768, 32767, out=mixed)
+    return mixed.astype(np.int16).tobytes()
+
+
+def stream_mix(timeline, audio_path, bg_volume, total_frames, output_args, input_args=(),
+               window_seconds=STREAM_WINDOW_SECONDS, metrics=None, ducker=None):
+    """分块解码背景音频、叠加配音并编码输出
+
+    每次只处理 window_seconds 秒的采样，峰值内存与输入长度无关。传入
+    ducker (BackgroundDucker) 时背景音量随对白闪避。
+    """
+    metrics = metrics or PipelineMetrics()
+    window_frames = OUTPUT_SAMPLE_RATE * window_seconds
+    frame_bytes = 2 * OUTPUT_CHANNELS
+
+    decoder = open_pcm_decoder(audio_path) if audio_path else None
+    encoder = open_pcm_encoder(output_args, input_args)
+    metrics.count('ffmpeg_processes', 2 if decoder else 1)
+    windows = [(start, min(window_frames, total_frames - start))
+               for start in range(0, total_frames, window_frames)]
+    background_queue = Queue(maxsize=BACKGROUND_PREFETCH_WINDOWS)
+
+    def read_background():
+        # 背景音频从一开始就在后台线程中解码，预先读取几个窗口，
+        # 等待配音时不会闲置
+        for _, frames in windows:
+            with metrics.stage('decode_background'):
+                try:
+                    data = read_exact(decoder.stdout, frames * frame_bytes)
+                except (OSError, ValueError):
+                    # 混音中止后管道已关闭
+                    data = b""
+            metrics.count('bytes_background_pcm', len(data))
+            background_queue.put(data)
+
+    reader = None
+    if decoder:
+        reader = threading.Thread(target=read_background, daemon=True)
+        reader.start()
+    received = 0
+    try:
+        for start, frames in windows:
+            background = None
+            if decoder:
+                data = background_queue.get()
+                if len(data) < frames * frame_bytes:
+                    check_pcm_decoder(decoder, received + len(data))
+                received += len(data)
+                background = np.frombuffer(data, dtype=np.int16).reshape(-1, OUTPUT_CHANNELS)
+
+            # 闪避需要窗口之后一小段内的字幕
+            timeline.wait(start + frames + (ducker.margin if ducker else 0))
+            with metrics.stage('mix'):
+                duck = functools.partial(ducker.apply, timeline, start) if ducker else None
+                pcm = mix_window(timeline.render(start, frames), background, bg_volume, duck)
+
+            with metrics.stage('encode'):
+                encoder.stdin.write(pcm)
+            metrics.count('bytes_output_pcm', len(pcm))
+
+        with metrics.stage('encode'):
+            encoder.stdin.close()
+            stderr = encoder.stderr.read()
+            returncode = encoder.wait()
+        if returncode != 0:
+            raise ConversionError(f"编码音频失败: {stderr.decode(errors='replace')}")
+    finally:
+        if decoder:
+            # 循环解码不会自行结束
+            decoder.kill()
+            decoder.wait()
+            # 让读取线程从已满的队列中退出
+            while reader.is_alive():
+                try:
+                    background_queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            decoder.error_log.close()
+        if encoder.poll() is None:
+            encoder.kill()
+            encoder.wait()
+
+
+def mp3_output_args(output_file, audio_stream='0:a:0'):
+    """编码为mp3的输出参数"""
+    return [
+        '-map', audio_stream,
+        '-c:a', 'libmp3lame',
+        '-q:a', '0',
+        '-b:a', '192k',
+        '-f', 'mp3',
+        '-y', output_file
+    ]
+
+
+def mp4_output_args(output_file):
+    """复制原视频流、编码混音音轨的输出参数，原视频为第一个输入"""
+    return [
+        '-map', '0:v:0',  # 使用原视频的第一个视频流
+        '-map', '1:a:0',  # 使用管道输入的混音音轨
+        '-c:v', 'copy',  # 复制视频流
+        '-c:a', 'aac',
+        '-b:a', '192k',
+        '-f', 'mp4',
+        '-y', output_file
+    ]
+
+
+def render_key(text, voice, rate, volume, duration_ms, time_stretch, resynth_threshold,
+               backend_version=None):
+    """调整好时长的语音片段的内容地址，可用时长和变速参数也参与计算"""
+    payload = json.dumps([
+        segment_cache_key(text, voice, rate, volume, backend_version),
+        duration_ms, time_stretch, resynth_threshold, MAX_STRETCH_SPEED, OUTPUT_SAMPLE_RATE
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def probe_duration(media_path):
+    """用 ffprobe 读取媒体时长（秒），失败时返回 None"""
+    process = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+         '-of', 'default=noprint_wrappers=1:nokey=1', media_path],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        return float(process.stdout.decode().strip())
+    except ValueError:
+        return None
+
+
+# 工程音轨 (MPEG-1 Layer III) 每帧的采样数
+MP3_FRAME_SAMPLES = 1152
+
+# Layer III 的比特率 (kbps) 和采样率表，按 MPEG 版本号索引
+# (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5)
+MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def parse_mp3_header(data, position):
+    """解析一个 Layer III 帧头，返回 (帧长度, 采样数, 采样率, 声道数, 侧信息长度)"""
+    header = int.from_bytes(data[position:position + 4], 'big')
+    version = (header >> 19) & 0x3
+    bitrate_index = (header >> 12) & 0xf
+    rate_index = (header >> 10) & 0x3
+    if (header >> 21 != 0x7ff or version == 1 or (header >> 17) & 0x3 != 1
+            or bitrate_index in (0, 15) or rate_index == 3):
+        raise ConversionError(f"无法解析的 MP3 帧 (偏移 {position})")
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[3 if mpeg1 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    mono = (header >> 6) & 0x3 == 3
+    length = (144 if mpeg1 else 72) * bitrate // sample_rate + ((header >> 9) & 1)
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    return length, 1152 if mpeg1 else 576, sample_rate, 1 if mono else 2, side_info
+
+
+def mp3_frames(data):
+    """解析 MP3 数据，返回 (音频帧开始的偏移, [(偏移, 长度)])
+
+    跳过开头的 ID3v2 标签和 Xing/Info 信息帧，结尾的 ID3v1 标签被忽略。
+    """
+    offset = 0
+    if data[:3] == b"ID3":
+        size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | data[9] & 0x7f
+        offset = 10 + size
+
+    frames = []
+    position = offset
+    while position + 4 <= len(data):
+        if data[position:position + 3] == b"TAG" and len(data) - position == 128:
+            break
+        length = parse_mp3_header(data, position)[0]
+        frames.append((position, length))
+        position += length
+
+    # Xing/Info 信息帧不含音频，位于侧信息之后
+    if frames:
+        tag = frames[0][0] + 4 + parse_mp3_header(data, frames[0][0])[4]
+        if data[tag:tag + 4] in (b"Xing", b"Info"):
+            offset = frames[0][0] + frames[0][1]
+            frames = frames[1:]
+    return offset, frames
+
+
+def mp3_stream_info(data):
+    """返回 MP3 数据中的 (音频帧数据, 总采样数, 采样率, 声道数)，不是 MP3 时抛出 ConversionError"""
+    _, frames = mp3_frames(data)
+    if not frames:
+        raise ConversionError("MP3 数据中没有音频帧")
+    _, samples, sample_rate, channels, _ = parse_mp3_header(data, frames[0][0])
+    start = frames[0][0]
+    end = frames[-1][0] + frames[-1][1]
+    return data[start:end], samples * len(frames), sample_rate, channels
+
+
+# 工程音轨使用 CBR 并关闭比特池 (bit reservoir)，每一帧只依赖自己的数据，
+# 重新编码的帧可以直接替换原文件中对应的帧
+PROJECT_MP3_CODEC_ARGS = ['-c:a', 'libmp3lame', '-b:a', '192k', '-reservoir', '0']
+
+
+def project_mp3_args(output_file, audio_stream='0:a:0'):
+    """工程音轨的输出参数"""
+    return ['-map', audio_stream, *PROJECT_MP3_CODEC_ARGS, '-f', 'mp3', '-y', output_file]
+
+
+def encode_mp3_frames(pcm):
+    """把一段 s16le PCM 编码为不带文件头的 MP3 帧"""
+    process = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error',
+         '-f', 's16le', '-ac', str(OUTPUT_CHANNELS), '-ar', str(OUTPUT_SAMPLE_RATE),
+         '-i', 'pipe:0', *PROJECT_MP3_CODEC_ARGS,
+         '-write_xing', '0', '-id3v2_version', '0', '-f', 'mp3', 'pipe:1'],
+        input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise ConversionError(f"编码音频失败: {process.stderr.decode(errors='replace')}")
+    return mp3_frames(process.stdout)[1], process.stdout
+
+
+def merge_ranges(ranges, gap=0):
+    """合并重叠或间隔不超过 gap 的区间"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def mux_video(media_path, audio_file, output_file):
+    """把工程音轨与原视频封装在一起，两者都直接复制"""
+    process = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error',
+         '-i', media_path, '-i', audio_file,
+         '-map', '0:v:0', '-map', '1:a:0',
+         '-c', 'copy', '-f', 'mp4', '-y', output_file],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise ConversionError(f"封装视频失败: {process.stderr.decode(errors='replace')}")
+
+
+class RenderProject:
+    """增量渲染的工程目录
+
+    manifest.json 记录每条字幕的时间和渲染键，segments/ 保存调整好时长
+    的语音片段，audio.mp3 是混音后的完整音轨。音轨各帧可以独立替换，
+    再次转换时只重新合成变化的字幕，只重新编码受影响时间段的 MP3 帧，
+    最后直接复制封装为输出文件。
+    """
+
+    VERSION = 1
+
+    # 重新编码时在变化区间前后多编码的帧数（提供编码器上下文）和替换的帧数
+    PREROLL_FRAMES = 4
+    MARGIN_FRAMES = 2
+
+    # 变化部分超过整条音轨的该比例时直接全部重新渲染
+    FULL_RENDER_RATIO = 0.5
+
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+        self.segment_dir = os.path.join(project_dir, "segments")
+        self.manifest_path = os.path.join(project_dir, "manifest.json")
+        self.audio_path = os.path.join(project_dir, "audio.mp3")
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != self.VERSION:
+            return None
+        return manifest
+
+    def segment_path(self, key):
+        return os.path.join(self.segment_dir, key + ".pcm")
+
+    def has_segment(self, key):
+        return os.path.exists(self.segment_path(key))
+
+    def save_segment(self, key, samples):
+        write_file_atomic(self.segment_path(key), samples.astype(np.int16).tobytes())
+
+    def load_segment(self, key):
+        return np.fromfile(self.segment_path(key), dtype=np.int16)
+
+    def segment_frames(self, key):
+        return os.path.getsize(self.segment_path(key)) // 2
+
+    @staticmethod
+    def settings(media_path, bg_volume, ducker=None):
+        """影响整条音轨的参数，变化时需要全部重新混音"""
+        media = None
+        if media_path:
+            stat = os.stat(media_path)
+            media = [os.path.abspath(media_path), stat.st_size, stat.st_mtime]
+        return {
+            'media': media,
+            'bg_volume': bg_volume,
+            'ducking': ducker.settings() if ducker else None,
+            'sample_rate': OUTPUT_SAMPLE_RATE,
+            'channels': OUTPUT_CHANNELS,
+        }
+
+    @staticmethod
+    def _cue_range(cue):
+        start = int(round(cue['start'] * OUTPUT_SAMPLE_RATE / 1000))
+        return start, start + int(round((cue['end'] - cue['start']) * OUTPUT_SAMPLE_RATE / 1000))
+
+    def _timeline(self, cues, segments, ranges=None, arena=None):
+        """用工程中的片段建立配音时间轴，指定 ranges 时只加载相交的字幕"""
+        timeline = DubTimeline(arena=arena)
+        for cue in cues:
+            if ranges is not None:
+                start, end = self._cue_range(cue)
+                if not any(start < b and end > a for a, b in ranges):
+                    continue
+            samples = segments.get(cue['key'])
+            if samples is None:
+                samples = self.load_segment(cue['key'])
+            timeline.add(samples, cue['start'])
+        return timeline
+
+    def changed_ranges(self, settings, cues, total_frames, margin=0):
+        """与上次渲染比较，返回需要重新渲染的帧区间；需要全部重新渲染时返回 None
+
+        margin 为每个区间前后额外包含的帧数（背景闪避的影响范围）。
+        """
+        manifest = self.manifest
+        if not manifest or not os.path.exists(self.audio_path):
+            return None
+        if manifest['settings'] != settings or manifest['total_frames'] != total_frames:
+            return None
+        old = {(c['start'], c['end'], c['key']) for c in manifest['cues']}
+        new = {(c['start'], c['end'], c['key']) for c in cues}
+        changed = [
+            self._cue_range({'start': start, 'end': end})
+            for start, end, _ in old ^ new
+        ]
+        return merge_ranges([(max(0, a - margin), min(total_frames, b + margin))
+                             for a, b in changed])
+
+    def render(self, cues, segments, media_path, bg_volume, log=print, metrics=None,
+               ducker=None, arena=None):
+        """更新工程音轨并保存清单
+
+        cues 为按字幕顺序排列的 {'start', 'end', 'key'}，segments 为本次新生成的
+        {渲染键: 采样}，其余片段从工程目录读取。arena 为混音时存放片段的
+        SegmentArena，不传入时临时创建。
+        """
+        metrics = metrics or PipelineMetrics()
+        ducker = ducker if media_path else None
+        margin = ducker.margin if ducker else 0
+        settings = self.settings(media_path, bg_volume, ducker)
+        end_frame = max((self._cue_range(c)[1] for c in cues), default=0)
+        # 配音结束后保留一秒，与 StreamingTimeline 一致
+        total_frames = end_frame + OUTPUT_SAMPLE_RATE
+
+        ranges = self.changed_ranges(settings, cues, total_frames, margin)
+        if ranges is not None and sum(b - a for a, b in ranges) > total_frames * self.FULL_RENDER_RATIO:
+            ranges = None
+
+        if ranges is None:
+            if self.manifest:
+                log("混音参数或总时长有变化，重新渲染整条音轨")
+            log("正在混合音频...")
+            timeline = self._timeline(cues, segments, arena=arena)
+            partial = self.audio_path + ".partial"
+            try:
+                stream_mix(timeline, media_path, bg_volume, total_frames,
+                           project_mp3_args(partial), metrics=metrics, ducker=ducker)
+                os.replace(partial, self.audio_path)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+        elif ranges:
+            seconds = sum(b - a for a, b in ranges) / OUTPUT_SAMPLE_RATE
+            log(f"只重新渲染变化的 {len(ranges)} 个区间 (共 {seconds:.1f}秒)...")
+            self._patch(ranges, cues, segments, media_path, bg_volume, total_frames, metrics,
+                        ducker, arena)
+        else:
+            log("配音没有变化，直接使用工程中的音轨")
+
+        self.manifest = {
+            'version': self.VERSION,
+            'settings': settings,
+            'total_frames': total_frames,
+            'cues': cues,
+        }
+        write_file_atomic(self.manifest_path,
+                          json.dumps(self.manifest, ensure_ascii=False).encode('utf-8'))
+        self._prune(cues)
+
+    def _patch(self, ranges, cues, segments, media_path, bg_volume, total_frames, metrics,
+               ducker=None, arena=None):
+        """重新编码变化区间附近的 MP3 帧并替换到工程音轨中"""
+        with open(self.audio_path, 'rb') as f:
+            data = f.read()
+        header_end, frames = mp3_frames(data)
+
+        # 区间换算为帧号，附近的区间合并后一起编码，减少ffmpeg调用
+        frame_ranges = merge_ranges(
+            [(max(0, a // MP3_FRAME_SAMPLES - self.MARGIN_FRAMES),
+              min(len(frames), -(-b // MP3_FRAME_SAMPLES) + self.MARGIN_FRAMES))
+             for a, b in ranges],
+            gap=2 * self.PREROLL_FRAMES
+        )
+        sample_ranges = [
+            (max(0, lo - self.PREROLL_FRAMES) * MP3_FRAME_SAMPLES,
+             min(total_frames, (hi + self.PREROLL_FRAMES) * MP3_FRAME_SAMPLES))
+            for lo, hi in frame_ranges
+        ]
+        # 闪避的增益还取决于区间前后 margin 帧内的字幕
+        margin = ducker.margin if ducker else 0
+        timeline = self._timeline(cues, segments,
+                                  [(a - margin, b + margin) for a, b in sample_ranges], arena)
+        background_frames = None
+        if media_path:
+            duration = probe_duration(media_path)
+            if duration:
+                background_frames = int(duration * OUTPUT_SAMPLE_RATE)
+
+        replacements = []
+        for (lo, hi), (a, b) in zip(frame_ranges, sample_ranges):
+            pcm = render_mix_window(timeline, media_path, bg_volume, a, b - a,
+                                    background_frames, metrics, ducker)
+            with metrics.stage('encode'):
+                chunk_frames, chunk = encode_mp3_frames(pcm)
+            metrics.count('ffmpeg_processes', 2 if media_path else 1)
+            first = a // MP3_FRAME_SAMPLES
+            if len(chunk_frames) < hi - first:
+                raise ConversionError("重新编码的音频帧数与工程音轨不一致，请删除工程目录后重试")
+            replacements.append((lo, hi, b"".join(
+                chunk[offset:offset + length]
+                for offset, length in chunk_frames[lo - first:hi - first]
+            )))
+
+        parts = [data[:header_end]]
+        position = 0
+        for lo, hi, chunk in replacements:
+            parts.append(data[frames[position][0]:frames[lo][0]] if lo > position else b"")
+            parts.append(chunk)
+            position = hi
+        if position < len(frames):
+            parts.append(data[frames[position][0]:])
+        write_file_atomic(self.audio_path, b"".join(parts))
+
+    def export(self, output_file, video_path=None, audio_file=None):
+        """把工程音轨复制为输出文件，有视频时直接复制封装"""
+        if video_path:
+            mux_video(video_path, self.audio_path, output_file)
+        else:
+            shutil.copyfile(self.audio_path, output_file)
+        if audio_file:
+            shutil.copyfile(self.audio_path, audio_file)
+
+    def _prune(self, cues):
+        """删除当前字幕已经不再使用的片段"""
+        keep = {cue['key'] + ".pcm" for cue in cues}
+        for name in os.listdir(self.segment_dir):
+            if name.endswith(".pcm") and name not in keep:
+                try:
+                    os.remove(os.path.join(self.segment_dir, name))
+                except OSError:
+                    pass
+
+
+def render_mix_window(timeline, audio_path, bg_volume, start, frames,
+                      background_frames=None, metrics=None, ducker=None):
+    """渲染从第 start 帧开始的一段混音，返回 s16le 字节
+
+    背景音频从对应位置开始解码，比配音短时按 background_frames 循环。
+    """
+    metrics = metrics or PipelineMetrics()
+    background = None
+    if audio_path:
+        offset = start % background_frames if background_frames else start
+        decoder = open_pcm_decoder(audio_path, start=offset / OUTPUT_SAMPLE_RATE)
+        try:
+            with metrics.stage('decode_background'):
+                data = read_exact(decoder.stdout, frames * 2 * OUTPUT_CHANNELS)
+            if len(data) < frames * 2 * OUTPUT_CHANNELS:
+                check_pcm_decoder(decoder, len(data))
+        finally:
+            decoder.kill()
+            decoder.wait()
+            decoder.error_log.close()
+        metrics.count('bytes_background_pcm', len(data))
+        background = np.frombuffer(data, dtype=np.int16).reshape(-1, OUTPUT_CHANNELS)
+
+    with metrics.stage('mix'):
+        duck = functools.partial(ducker.apply, timeline, start) if ducker else None
+        return mix_window(timeline.render(start, frames), background, bg_volume, duck)
+
+
+def get_project_dir(subtitle_path, media_path=None):
+    """增量渲染的工程目录，与输出文件放在一起"""
+    return os.path.splitext(get_output_path(subtitle_path, media_path))[0] + ".project"
+
+
+def get_job_dir(subtitle_path, media_path=None):
+    """可恢复任务的目录，与输出文件放在一起"""
+    return os.path.splitext(get_output_path(subtitle_path, media_path))[0] + ".job"
+
+
+class ConversionJob:
+    """可恢复的转换任务目录
+
+    每条字幕的语音解码后保存到 segments/，再向 journal.jsonl 追加一行记录
+    （失败的字幕也记录原因）。进程中途退出或网络中断后用 resume=True
+    打开同一目录，渲染键相同且已完成的字幕直接读取保存的语音，只重新
+    处理失败或缺失的字幕。转换全部成功后删除任务目录。record_done() 和
+    record_failed() 会写盘并 fsync，可以在多个线程中同时调用。
+    """
+
+    def __init__(self, job_dir, resume=False):
+        self.job_dir = job_dir
+        self.segment_dir = os.path.join(job_dir, "segments")
+        self.journal_path = os.path.join(job_dir, "journal.jsonl")
+        self.completed = {}  # {字幕下标: 渲染键}
+        self.failed = {}  # {字幕下标: 失败原因}
+        self._lock = threading.Lock()
+        if resume:
+            self._read_journal()
+        else:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _read_journal(self):
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # 进程退出时写了一半的记录
+                continue
+            cue = entry['cue']
+            if entry['status'] == 'done':
+                self.completed[cue] = entry['key']
+                self.failed.pop(cue, None)
+            else:
+                self.completed.pop(cue, None)
+                self.failed[cue] = entry.get('error', '')
+
+    def segment_path(self, key):
+        return os.path.join(self.segment_dir, key + ".pcm")
+
+    def load(self, index, key):
+        """读取已完成字幕的语音，没有完成或渲染键不同时返回 None"""
+        if self.completed.get(index) != key:
+            return None
+        try:
+            return np.fromfile(self.segment_path(key), dtype=np.int16)
+        except OSError:
+            return None
+
+    def _append(self, entry):
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def record_done(self, index, key, samples):
+        """保存一条字幕的语音，再记录为已完成"""
+        path = self.segment_path(key)
+        if not os.path.exists(path):
+            write_file_atomic(path, samples.astype(np.int16).tobytes())
+        with self._lock:
+            self.completed[index] = key
+            self.failed.pop(index, None)
+            self._append({'cue': index, 'key': key, 'status': 'done'})
+
+    def record_failed(self, index, key, error):
+        with self._lock:
+            self.completed.pop(index, None)
+            self.failed[index] = str(error)
+            self._append({'cue': index, 'key': key, 'status': 'failed', 'error': str(error)})
+
+    def close(self):
+        self._journal.close()
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def decode_audio_data(data, sample_rate=OUTPUT_SAMPLE_RATE):
+    """解码一段合成好的音频数据，返回一维 int16 单声道采样
+
+    WAV 在进程内解析，其他格式由 pydub 调用ffmpeg解码。
+    """
+    segment = AudioSegment.from_file(io.BytesIO(data), format="wav" if data[:4] == b"RIFF" else None)
+    return audio_segment_to_array(segment, sample_rate, 1)[:, 0]
+
+
+def decode_mp3_group(streams, source_rate, channels, sample_rate=OUTPUT_SAMPLE_RATE):
+    """把多段参数相同的 MP3 拼接后交给一个ffmpeg进程解码，再按各段的采样数切分
+
+    streams 为 [(音频帧数据, 采样数)]。解码保持原采样率，切分位置是整数
+    采样，不会引入误差；之后与单独解码时一样逐段重采样。
+    """
+    process = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-f', 'mp3', '-i', 'pipe:0',
+         '-f', 's16le', '-ac', str(channels), '-ar', str(source_rate), 'pipe:1'],
+        input=b"".join(data for data, _ in streams),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise ConversionError(f"解码语音失败: {process.stderr.decode(errors='replace')}")
+    frame_bytes = 2 * channels
+    if len(process.stdout) != sum(samples for _, samples in streams) * frame_bytes:
+        raise ConversionError("解码后的采样数与 MP3 帧数不一致")
+
+    outputs = []
+    position = 0
+    for _, samples in streams:
+        raw = process.stdout[position:position + samples * frame_bytes]
+        position += samples * frame_bytes
+        segment = AudioSegment(raw, frame_rate=source_rate, sample_width=2, channels=channels)
+        outputs.append(audio_segment_to_array(segment, sample_rate, 1)[:, 0])
+    return outputs
+
+
+def decode_audio_batch(items, sample_rate=OUTPUT_SAMPLE_RATE):
+    """批量解码合成好的音频数据，返回与输入顺序一致的一维 int16 采样列表
+
+    MP3 按帧头计算采样数后拼接起来，同样参数的一组只启动一个ffmpeg进程，
+    拼接解码失败时退回逐段解码；其他格式（例如本地后端的 WAV）在进程内
+    解码。解码失败的项为对应的异常对象。
+    """
+    results = [None] * len(items)
+    groups = {}
+    for n, data in enumerate(items):
+        try:
+            frames, samples, source_rate, channels = mp3_stream_info(data)
+        except (ConversionError, IndexError):
+            try:
+                results[n] = decode_audio_data(data, sample_rate)
+            except Exception as e:
+                results[n] = e
+            continue
+        groups.setdefault((source_rate, channels), []).append((n, frames, samples))
+
+    for (source_rate, channels), group in groups.items():
+        try:
+            outputs = decode_mp3_group([(frames, samples) for _, frames, samples in group],
+                                       source_rate, channels, sample_rate)
+        except ConversionError:
+            outputs = []
+            for n, _, _ in group:
+                try:
+                    outputs.append(decode_audio_data(items[n], sample_rate))
+                except Exception as e:
+                    outputs.append(e)
+        for (n, _, _), output in zip(group, outputs):
+            results[n] = output
+    return results
+
+
+class WSOLAStretcher:
+    """波形相似重叠相加 (WSOLA) 时间压缩，音高不变
+
+    每一帧在允许的偏移范围内用互相关寻找与上一帧自然延续最相似的位置，
+    再加窗叠加。互相关由 numpy 一次算出，逐帧的 Python 循环次数只与
+    片段时长成正比。
+    """
+
+    name = "wsola"
+
+    def __init__(self, sample_rate=OUTPUT_SAMPLE_RATE, frame_ms=40, tolerance_ms=10):
+        self.frame = int(sample_rate * frame_ms / 1000) // 2 * 2
+        self.hop = self.frame // 2
+        self.tolerance = int(sample_rate * tolerance_ms / 1000)
+        self.window = np.hanning(self.frame).astype(np.float32)
+
+    def stretch(self, samples, speed):
+        """按 speed 倍速播放，返回一维 int16 采样"""
+        if speed == 1 or len(samples) < self.frame:
+            return samples
+        frame, hop, tol = self.frame, self.hop, self.tolerance
+        analysis_hop = hop * speed
+        out_len = int(np.ceil(len(samples) / speed))
+        pad = frame + tol
+        x = np.concatenate([
+            np.zeros(pad, np.float32),
+            samples.astype(np.float32),
+            np.zeros(pad + int(analysis_hop) + frame, np.float32)
+        ])
+
+        n_frames = out_len // hop + 1
+        y = np.zeros(n_frames * hop + frame, np.float32)
+        weight = np.zeros_like(y)
+        delta = 0
+        for m in range(n_frames):
+            pos = pad + int(m * analysis_hop) + delta
+            y[m * hop:m * hop + frame] += x[pos:pos + frame] * self.window
+            weight[m * hop:m * hop + frame] += self.window
+
+            # 在下一帧的名义位置附近寻找与自然延续最相似的片段
+            natural = x[pos + hop:pos + hop + frame]
+            nominal = pad + int((m + 1) * analysis_hop)
+            search = x[nominal - tol:nominal + frame + tol]
+            if len(search) < frame + 2 * tol:
+                break
+            delta = self._best_offset(search, natural)
+
+        y = y[:out_len] / np.maximum(weight[:out_len], 1e-3)
+        return np.clip(y, -32768, 32767).astype(np.int16)
+
+    def _best_offset(self, search, natural, step=4):
+        """返回 natural 在 search 中最相似位置相对中心的偏移
+
+        先在降采样的信号上粗搜，再在原始采样上细化，互相关的计算量约为
+        全分辨率搜索的 1/step²。
+        """
+        tol = self.tolerance
+        coarse = np.correlate(search[::step], natural[::step], 'valid')
+        center = int(np.argmax(coarse)) * step
+        lo = max(0, center - step)
+        hi = min(2 * tol, center + step)
+        fine = np.correlate(search[lo:hi + len(natural)], natural, 'valid')
+        return lo + int(np.argmax(fine)) - tol
+
+    def stretch_batch(self, items):
+        """批量处理 [(采样, 倍速)]"""
+        return [self.stretch(samples, speed) for samples, speed in items]
+
+
+class AtempoStretcher:
+    """使用ffmpeg atempo 滤镜批量变速
+
+    一批片段写入临时 WAV 后由一个ffmpeg进程同时处理，每批只启动一次进程。
+    """
+
+    name = "atempo"
+
+    def __init__(self, sample_rate=OUTPUT_SAMPLE_RATE, batch_size=32):
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _atempo_chain(speed):
+        # 单个 atempo 只支持 0.5-2.0 倍，超出时串联多个
+        filters = []
+        while speed > 2.0:
+            filters.append("atempo=2.0")
+            speed /= 2.0
+        filters.append(f"atempo={speed:.6f}")
+        return ",".join(filters)
+
+    def stretch(self, samples, speed):
+        return self.stretch_batch([(samples, speed)])[0]
+
+    def stretch_batch(self, items):
+        results = []
+        for offset in range(0, len(items), self.batch_size):
+            results.extend(self._run_batch(items[offset:offset + self.batch_size]))
+        return results
+
+    def _run_batch(self, items):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            command = ['ffmpeg', '-loglevel', 'error']
+            filters = []
+            outputs = []
+            for i, (samples, speed) in enumerate(items):
+                input_file = os.path.join(temp_dir, f"in_{i}.wav")
+                with wave.open(input_file, 'wb') as f:
+                    f.setnchannels(1)
+                    f.setsampwidth(2)
+                    f.setframerate(self.sample_rate)
+                    f.writeframes(samples.tobytes())
+                command += ['-i', input_file]
+                filters.append(f"[{i}:a]{self._atempo_chain(speed)}[o{i}]")
+                outputs.append(os.path.join(temp_dir, f"out_{i}.raw"))
+
+            command += ['-filter_complex', ";".join(filters)]
+            for i, output_file in enumerate(outputs):
+                command += ['-map', f'[o{i}]', '-f', 's16le', '-ac', '1',
+                            '-ar', str(self.sample_rate), '-y', output_file]
+
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                raise ConversionError(f"变速处理失败: {process.stderr.decode(errors='replace')}")
+            return [np.fromfile(output_file, dtype=np.int16) for output_file in outputs]
+
+
+# 可选的时间伸缩引擎
+TIME_STRETCH_ENGINES = {
+    WSOLAStretcher.name: WSOLAStretcher,
+    AtempoStretcher.name: AtempoStretcher,
+}
+DEFAULT_TIME_STRETCH = WSOLAStretcher.name
+
+# 需要加速超过该倍数时改用更快的语速重新合成，None 表示不重新合成
+DEFAULT_RESYNTH_THRESHOLD = 1.5
+
+# 重新合成时 edge-tts 语速的上限
+MAX_RESYNTH_RATE = 100
+
+
+def get_time_stretcher(name=DEFAULT_TIME_STRETCH):
+    """按名称创建时间伸缩引擎"""
+    try:
+        return TIME_STRETCH_ENGINES[name]()
+    except KeyError:
+        raise ConversionError(f"未知的变速引擎: {name}")
+
+
+def parse_percent(value):
+    """解析 "+25%" 形式的参数"""
+    return int(str(value).strip().rstrip('%') or 0)
+
+
+def faster_rate(rate, speed):
+    """计算让语音加快 speed 倍所需的 edge-tts 语速参数"""
+    percent = (1 + parse_percent(rate) / 100) * speed * 100 - 100
+    percent = int(min(MAX_RESYNTH_RATE, np.ceil(percent)))
+    return f"{percent:+d}%"
+
+
+class DecoderPool:
+    """常驻的语音解码线程池
+
+    合成好的音频数据用 submit() 放入队列后立即得到 Future，workers 个线程
+    各自从队列中取出最多 batch_size 段交给 decode_audio_batch，一批只启动
+    一个ffmpeg进程。解码与语音合成同时进行，多核时各批并行解码。批量
+    处理时多个文件共用一个线程池，所以 metrics 随每段数据传入，每批的
+    解码时间记入这一批涉及的各个文件的 'decode' 阶段。
+    """
+
+    def __init__(self, workers=None, batch_size=64, linger=0.05):
+        self.batch_size = batch_size
+        self.linger = linger  # 凑满一批前最多等待的秒数
+        self.queue = Queue()
+        self.threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(workers or min(4, os.cpu_count() or 1))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, data, metrics=None):
+        """提交一段音频数据，返回解码结果（一维 int16 采样）的 Future"""
+        future = concurrent.futures.Future()
+        self.queue.put((data, future, metrics))
+        return future
+
+    def _next_batch(self):
+        """取出下一批任务，收到结束标记时返回 None"""
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if item is None:
+                # 结束标记留给下一次取
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            start = time.perf_counter()
+            try:
+                outputs = decode_audio_batch([data for data, _, _ in batch])
+            except Exception as e:
+                outputs = [e] * len(batch)
+            elapsed = time.perf_counter() - start
+            for metrics in {id(m): m for _, _, m in batch if m}.values():
+                metrics.add_time('decode', elapsed)
+            for (_, future, _), output in zip(batch, outputs):
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    def close(self):
+        """处理完队列中的任务后结束所有线程"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+# 字幕排布：语音最多向后借用的空隙，以及与下一条字幕之间保留的间隔 (毫秒)
+MAX_BORROW_MS = 1000
+MIN_CUE_GAP_MS = 100
+
+# 合并相邻短字幕的条件：单条时长、间隔和合并后的总时长上限 (毫秒)
+MERGE_MAX_CUE_MS = 600
+MERGE_MAX_GAP_MS = 250
+MERGE_MAX_TOTAL_MS = 3000
+
+# 时长调整的最大加速倍数，超过时语音延续到后面的时间
+MAX_STRETCH_SPEED = 2.0
+
+
+def schedule_cues(subs, lines):
+    """按开始时间一次线性扫描排布字幕，返回 (时间段列表, 时间重叠的字幕数)
+
+    lines 为 [(字幕下标, 文本)]。与其他字幕时间重叠的字幕单独成段且不借用
+    空隙；相邻的短字幕合并为一次合成请求；其余字幕的可用时长延伸到下一段
+    之前的空隙（最多 MAX_BORROW_MS）。每个时间段为 {'index', 'cues', 'text',
+    'start', 'end', 'limit'}，index 为第一条字幕的下标，limit 为语音不需要
+    加速就能占用到的时间。
+    """
+    order = sorted(lines, key=lambda line: (subs[line[0]].start, line[0]))
+    starts = [subs[i].start for i, _ in order]
+    ends = [subs[i].end for i, _ in order]
+
+    # 开始时间排序后，与前面任一字幕重叠等价于开始早于前面的最晚结束时间，
+    # 与后面任一字幕重叠等价于下一条的开始早于本条结束
+    overlapping = []
+    latest_end = None
+    for k in range(len(order)):
+        overlapping.append(
+            (latest_end is not None and starts[k] < latest_end)
+            or (k + 1 < len(order) and starts[k + 1] < ends[k])
+        )
+        latest_end = ends[k] if latest_end is None else max(latest_end, ends[k])
+
+    slots = []
+    mergeable = False
+    for k, (i, text) in enumerate(order):
+        short = ends[k] - starts[k] <= MERGE_MAX_CUE_MS and not overlapping[k]
+        if (mergeable and short
+                and starts[k] - slots[-1]['end'] <= MERGE_MAX_GAP_MS
+                and ends[k] - slots[-1]['start'] <= MERGE_MAX_TOTAL_MS):
+            slot = slots[-1]
+            slot['cues'].append(i)
+            slot['text'] += " " + text
+            slot['end'] = ends[k]
+            continue
+        slots.append({'index': i, 'cues': [i], 'text': text,
+                      'start': starts[k], 'end': ends[k], 'overlapping': overlapping[k]})
+        mergeable = short
+
+    for k, slot in enumerate(slots):
+        slot['limit'] = slot['end']
+        if not slot.pop('overlapping'):
+            next_start = slots[k + 1]['start'] if k + 1 < len(slots) else float('inf')
+            slot['limit'] = max(slot['end'], min(slot['end'] + MAX_BORROW_MS,
+                                                 next_start - MIN_CUE_GAP_MS))
+    return slots, sum(overlapping)
+
+
+def fit_segments(slots, decoded, stretcher):
+    """把语音片段放进各自的时间段
+
+    decoded 为 {下标: (文本, 采样)}。不超过可用时长 (limit) 的语音保持原速，
+    超过的片段一起交给 stretcher 批量加速到可用时长；加速倍数不超过
+    MAX_STRETCH_SPEED，仍放不下的部分延续到后面。
+    """
+    ms_to_frames = lambda ms: int(round(ms * OUTPUT_SAMPLE_RATE / 1000))
+
+    to_stretch = []
+    for i, (text, samples) in decoded.items():
+        window = ms_to_frames(slots[i]['limit'] - slots[i]['start'])
+        if len(samples) > window:
+            to_stretch.append((i, min(MAX_STRETCH_SPEED, len(samples) / window)))
+
+    stretched = {}
+    if to_stretch:
+        outputs = stretcher.stretch_batch([(decoded[i][1], speed) for i, speed in to_stretch])
+        stretched = {
+            i: samples[:int(round(len(decoded[i][1]) / speed))]
+            for (i, speed), samples in zip(to_stretch, outputs)
+        }
+
+    return [
+        {
+            'index': i,
+            'start': slots[i]['start'],
+            'samples': stretched.get(i, samples),
+            'text': text
+        }
+        for i, (text, samples) in sorted(decoded.items())
+    ]
+
+
+async def convert_subtitle_file(subtitle_path, media_path=None, voice=DEFAULT_VOICE,
+                                rate="+0%", volume="+0%", bg_volume=5,
+                                concurrency=DEFAULT_TTS_CONCURRENCY, cache=None,
+                                keep_audio=True, time_stretch=DEFAULT_TIME_STRETCH,
+                                resynth_threshold=DEFAULT_RESYNTH_THRESHOLD,
+                                backend=None, metrics=None, incremental=False, log=print,
+                                progress=None, limiter=None, throttle=None, executor=None,
+                                decoder=None, checkpoint=False, resume=False, group_cues=0,
+                                bg_gap_volume=None, arena=None):
+    """将字幕转换为配音，不依赖图形界面
+
+    bg_volume 为原始音频音量百分比 (0-100)；给出 bg_gap_volume 时 bg_volume
+    只用于对白期间，对白之间原始音频恢复为 bg_gap_volume (BackgroundDucker)。
+    原始音频直接从媒体文件解码为
+    PCM 参与混音，视频的音轨编码和封装由同一个ffmpeg进程一次完成；
+    keep_audio 为 True 时同一进程还会输出一份 _s.mp3。比字幕长的语音由
+    time_stretch 指定的引擎压缩，需要加速超过 resynth_threshold 倍时先用
+    更快的语速重新合成，音质更自然。backend 为语音合成后端，默认使用
+    edge-tts；传入 metrics 可以在结束后取得各阶段的统计。incremental 为
+    True 时在输出文件旁保存工程目录，再次转换只重新合成和编码变化的字幕。
+    checkpoint 为 True 时每条字幕完成后记录到任务目录 (ConversionJob)，
+    中断或有字幕失败后用 resume=True 再次转换，只处理失败或缺失的字幕。
+    group_cues 大于 1 时相邻的字幕合并为一次合成请求（见 schedule_synthesis）。
+    合成好的语音交给 decoder (DecoderPool) 在后台解码，不传入时使用本次
+    转换专用的线程池。混音从一开始就在 executor 中运行，与语音合成同时进行，
+    按时间顺序等待各字幕就绪；批量处理时多个文件的各阶段也可以互相重叠。
+    解码后和调整好时长的语音都存放在 arena (SegmentArena) 中，多次转换可以
+    传入同一个存储区复用，但不能同时使用。返回生成的音频或视频文件路径，
+    失败时抛出 ConversionError。
+    """
+    async with contextlib.AsyncExitStack() as resources:
+        # 调用方没有传入的后端、解码线程池和片段存储区由本次转换创建，结束时释放
+        if backend is None:
+            # 连接池大小与并发数一致
+            backend = create_tts_backend(pool_size=concurrency)
+            resources.push_async_callback(backend.close)
+        if decoder is None:
+            decoder = DecoderPool()
+            resources.callback(decoder.close)
+        if arena is None:
+            arena = SegmentArena()
+            resources.callback(arena.close)
+
+        total_start_time = datetime.now()
+        loop = asyncio.get_running_loop()
+        metrics = metrics or PipelineMetrics()
+        cache_hits, cache_misses = (cache.hits, cache.misses) if cache else (0, 0)
+        connections = backend.connections
+        # 首次合成和重新合成共用同一个并发上限和限流状态
+        limiter = limiter or asyncio.Semaphore(max(1, concurrency))
+        throttle = throttle or TTSThrottle()
+
+        # 检查是否选择了视频文件
+        is_video = bool(media_path) and media_path.lower().endswith(VIDEO_EXTENSIONS)
+        ducker = (BackgroundDucker(bg_volume, bg_gap_volume)
+                  if media_path and bg_gap_volume is not None else None)
+
+        # 加载字幕文件
+        try:
+            with metrics.stage('parse'):
+                subs = pysubs2.load(subtitle_path)
+        except Exception as e:
+            raise ConversionError(f"读取字幕文件失败: {str(e)}")
+        metrics.count('cues', len(subs))
+        metrics.info['backend'] = backend.name
+
+        # 转换字幕
+        convert_start = datetime.now()
+        total = len(subs)
+        log(f"开始转换 {total} 条字幕...")
+
+        # 重置进度条
+        if progress:
+            progress(0)
+
+        # 排布所有非空字幕，相邻的短字幕合并为一段，按时间顺序合成
+        pending_lines = [(i, normalize_line_text(line)) for i, line in enumerate(subs)
+                         if line.end > line.start]
+        pending_lines = [(i, text) for i, text in pending_lines if text]
+        slot_list, overlapping = schedule_cues(subs, pending_lines)
+        slots = {slot['index']: slot for slot in slot_list}
+        metrics.count('merged_cues', len(pending_lines) - len(slot_list))
+        metrics.count('overlapping_cues', overlapping)
+        if len(slot_list) < len(pending_lines) or overlapping:
+            log(f"合并相邻短字幕后共 {len(slot_list)} 段，{overlapping} 条字幕时间互相重叠")
+        pending_lines = [(slot['index'], slot['text']) for slot in slot_list]
+
+        # 重复的台词只合成一次
+        unique_lines = len({text for _, text in pending_lines})
+        metrics.count('unique_lines', unique_lines)
+        if pending_lines:
+            log(f"去重后需要合成 {unique_lines} 条 "
+                f"(重复 {1 - unique_lines / len(pending_lines):.0%})")
+
+        render_keys = {}
+        if incremental or checkpoint or resume:
+            render_keys = {
+                i: render_key(text, voice, rate, volume, slots[i]['limit'] - slots[i]['start'],
+                              time_stretch, resynth_threshold, backend.version)
+                for i, text in pending_lines
+            }
+
+        # 增量渲染时，工程中已有的片段不再合成
+        project = None
+        reused = set()
+        if incremental:
+            project = RenderProject(get_project_dir(subtitle_path, media_path))
+            reused = {i for i, key in render_keys.items() if project.has_segment(key)}
+            pending_lines = [line for line in pending_lines if line[0] not in reused]
+            if reused:
+                log(f"工程中已有 {len(reused)} 条字幕的语音，只处理 {len(pending_lines)} 条")
+        if not pending_lines and not reused:
+            raise ConversionError("没有成功转换任何音频片段")
+
+        # 恢复任务时，上次已完成的字幕直接读取保存的语音
+        job = None
+        resumed = {}
+        if checkpoint or resume:
+            job_dir = get_job_dir(subtitle_path, media_path)
+            if not resume and os.path.isdir(job_dir):
+                log("⚠️ 丢弃上次未完成的任务，重新开始")
+            job = ConversionJob(job_dir, resume)
+            for i, text in pending_lines:
+                samples = job.load(i, render_keys[i])
+                if samples is not None:
+                    resumed[i] = (text, samples)
+            if resume:
+                log(f"从任务目录恢复 {len(resumed)} 条字幕，需要重新处理 "
+                    f"{len(pending_lines) - len(resumed)} 条")
+        synth_lines = [line for line in pending_lines if line[0] not in resumed]
+
+        # 各阶段流水线式同时进行：合成好的语音立即在 decoder 中解码，解码后
+        # 交给时间线；混音线程从一开始就解码背景音频，按时间顺序等待窗口内
+        # 的字幕就绪后调整时长、混音并编码
+        stretcher = get_time_stretcher(time_stretch)
+        arena.clear()
+        timeline = StreamingTimeline({i: slots[i] for i, _ in pending_lines}, stretcher, metrics,
+                                     arena)
+        for i, (text, samples) in resumed.items():
+            timeline.ready(i, text, samples)
+        can_resynth = bool(resynth_threshold) and backend.capabilities()['rate']
+        tasks = schedule_synthesis(
+            synth_lines, voice, rate, volume, concurrency,
+            cache=cache, progress=progress, limiter=limiter, throttle=throttle,
+            backend=backend, metrics=metrics, decoder=decoder, group_cues=group_cues,
+            log=log
+        )
+
+        async def prepare(k, i, text):
+            """等待第 k 个任务的语音解码完成，交给时间线"""
+            try:
+                samples = await asyncio.wrap_future(await tasks[k])
+            except Exception as e:
+                log(f"⚠️ 第{i+1}条字幕转换失败: {str(e)}")
+                if job:
+                    # 写盘和 fsync 放到线程池中，不阻塞其他字幕的合成
+                    await loop.run_in_executor(None, job.record_failed, i, render_keys[i], e)
+                timeline.failed(i, e)
+                return
+            # 解码结果随后暂存到 arena，任务列表不再引用它，避免整部影片的语音
+            # 都留在内存中（相同台词的其他字幕仍持有同一个任务）
+            tasks[k] = None
+
+            # 语音明显长于字幕时，用更快的语速重新合成比强行压缩更自然
+            target = (slots[i]['limit'] - slots[i]['start']) * OUTPUT_SAMPLE_RATE / 1000
+            if can_resynth and target > 0 and len(samples) / target > resynth_threshold:
+                new_rate = faster_rate(rate, len(samples) / target)
+                if new_rate != rate:
+                    metrics.count('resynthesized_cues')
+                    retry_start = time.perf_counter()
+                    retry, = await synthesize_lines(
+                        [(i, text, new_rate)], voice, rate, volume, concurrency,
+                        cache=cache, limiter=limiter, throttle=throttle, backend=backend,
+                        metrics=metrics, decoder=decoder, log=log
+                    )
+                    try:
+                        if isinstance(retry, Exception):
+                            raise retry
+                        samples = await asyncio.wrap_future(retry)
+                    except Exception as e:
+                        # 重新合成失败时保留原来的语音
+                        log(f"⚠️ 第{i+1}条字幕重新合成失败: {str(e)}")
+                    metrics.add_time('resynthesis', time.perf_counter() - retry_start)
+            if job:
+                await loop.run_in_executor(None, job.record_done, i, render_keys[i], samples)
+            timeline.ready(i, text, samples)
+
+        async def synthesize_all():
+            with metrics.stage('synthesis'):
+                await asyncio.gather(*(
+                    prepare(k, i, text) for k, (i, text) in enumerate(synth_lines)
+                ))
+            metrics.count('failed_cues', len(timeline.failures))
+            log(f"✓ 字幕转换完成 (耗时: {format_time_delta(convert_start)})")
+            if timeline.failures:
+                # 列出最终没能转换的字幕，输出中这些位置没有配音
+                log(f"⚠️ {len(timeline.failures)} 条字幕未能转换，输出中这些位置没有配音:")
+                for i, error in sorted(timeline.failures.items()):
+                    slot = slots[i]
+                    log(f"  第{'、'.join(str(cue + 1) for cue in slot['cues'])}条 "
+                        f"[{pysubs2.time.ms_to_str(slot['start'], fractions=True)}] "
+                        f"{slot['text']}: {str(error)}")
+            if cache:
+                log(f"  {cache.stats_text()}")
+                metrics.count('cache_hits', cache.hits - cache_hits)
+                metrics.count('cache_misses', cache.misses - cache_misses)
+            metrics.count('tts_connections', backend.connections - connections)
+            if len(timeline.failures) == len(pending_lines) and not reused:
+                raise ConversionError("没有成功转换任何音频片段")
+
+        output = get_output_path(subtitle_path, media_path)
+        base, ext = os.path.splitext(output)
+
+        # 先写入临时文件再重命名，已存在的输出文件一定是完整的
+        renames = [(f"{base}.partial{ext}", output)]
+        if is_video and keep_audio:
+            renames.append((f"{base}.partial.mp3", f"{base}.mp3"))
+
+        mix_start = datetime.now()
+        try:
+            if project:
+                # 工程模式需要知道所有变化的片段才能决定重新编码的范围
+                await synthesize_all()
+                with metrics.stage('time_fit'):
+                    audio_segments = await loop.run_in_executor(
+                        executor, fit_segments, slots, timeline.drain(), stretcher
+                    )
+                if not audio_segments and not reused:
+                    raise ConversionError("没有成功转换任何音频片段")
+
+                new_segments = {
+                    render_keys[segment['index']]: segment['samples'] for segment in audio_segments
+                }
+                # 语音可能延续到字幕结束之后，按片段的实际长度记录时间范围
+                frames = {segment['index']: len(segment['samples']) for segment in audio_segments}
+                frames.update((i, project.segment_frames(render_keys[i])) for i in reused)
+                cues = [
+                    {'start': slots[i]['start'],
+                     'end': slots[i]['start'] + frames[i] * 1000 / OUTPUT_SAMPLE_RATE,
+                     'key': render_keys[i]}
+                    for i in sorted(frames)
+                ]
+
+                def export():
+                    for key, samples in new_segments.items():
+                        project.save_segment(key, samples)
+                    project.render(cues, new_segments, media_path, bg_volume, log, metrics,
+                                   ducker, arena)
+                    project.export(renames[0][0], media_path if is_video else None,
+                                   renames[1][0] if len(renames) > 1 else None)
+
+                if is_video:
+                    log("正在生成最终视频...")
+                mix_start = datetime.now()
+                await loop.run_in_executor(executor, export)
+            else:
+                if is_video:
+                    input_args = ['-i', media_path]
+                    output_args = mp4_output_args(renames[0][0])
+                    if keep_audio:
+                        output_args += mp3_output_args(renames[1][0], '1:a:0')
+                else:
+                    input_args = []
+                    output_args = mp3_output_args(renames[0][0])
+
+                mixing = loop.run_in_executor(
+                    executor, stream_mix, timeline, media_path, bg_volume,
+                    timeline.total_frames, output_args, input_args,
+                    STREAM_WINDOW_SECONDS, metrics, ducker
+                )
+                synthesis = asyncio.ensure_future(synthesize_all())
+                try:
+                    await asyncio.wait({mixing, synthesis}, return_when=asyncio.FIRST_EXCEPTION)
+                    if mixing.done():
+                        mixing.result()
+                    await synthesis
+                    if is_video:
+                        log("正在生成最终视频...")
+                    elif media_path:
+                        log("正在混合音频...")
+                    await mixing
+                except BaseException:
+                    timeline.cancel()
+                    synthesis.cancel()
+                    for task in tasks:
+                        if task:
+                            task.cancel()
+                    await asyncio.gather(mixing, synthesis, return_exceptions=True)
+                    raise
+                if not timeline.placed:
+                    raise ConversionError("没有成功转换任何音频片段")
+        except BaseException:
+            for partial, _ in renames:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            if job:
+                job.close()
+                log(f"任务进度已保存到 {job.job_dir}，使用 --resume 可以从中断处继续")
+            raise
+        for partial, final in renames:
+            os.replace(partial, final)
+            metrics.count('bytes_output_files', os.path.getsize(final))
+        log(f"✓ {'视频' if is_video else '音频'}生成完成 (耗时: {format_time_delta(mix_start)})")
+
+        if job:
+            if timeline.failures:
+                job.close()
+                log(f"使用 --resume 可以只重试失败的 {len(timeline.failures)} 条字幕")
+            else:
+                job.remove()
+
+        # 显示总耗时和各阶段统计
+        log(f"\n✨ 全部处理完成！总耗时: {format_time_delta(total_start_time)}")
+        for line in metrics.summary_lines():
+            log(line)
+
+        return output
+
+
+def convert_subtitle_headless(subtitle_path, media_path=None, **options):
+    """在当前线程中运行完整转换流程，供脚本和批处理调用"""
+    async def convert():
+        try:
+            return await convert_subtitle_file(subtitle_path, media_path, **options)
+        finally:
+            # 复用的连接属于即将结束的事件循环
+            if options.get('backend'):
+                await options['backend'].close()
+
+    return asyncio.run(convert())
+
+
+# 批量模式识别的字幕和媒体扩展名
+SUBTITLE_EXTENSIONS = ('.srt', '.ass')
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.m4a', '.aac')
+
+
+def find_batch_jobs(root_dir):
+    """在目录树中查找同名的字幕和媒体文件，返回 (字幕, 媒体) 列表
+
+    没有同名媒体文件的字幕只生成配音音频，媒体为 None。
+    """
+    jobs = []
+    for current_dir, dirs, files in os.walk(root_dir):
+        dirs.sort()
+        # 不把上一次的输出 (xxx_s.mp4) 当作输入
+        media_by_stem = {}
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in VIDEO_EXTENSIONS + AUDIO_EXTENSIONS and not stem.endswith('_s'):
+                # 同名时优先使用视频文件
+                if stem not in media_by_stem or ext.lower() in VIDEO_EXTENSIONS:
+                    media_by_stem[stem] = os.path.join(current_dir, name)
+
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in SUBTITLE_EXTENSIONS:
+                continue
+            # 也匹配 "episode.zh.srt" 这类带语言后缀的字幕
+            media = media_by_stem.get(stem) or media_by_stem.get(stem.rsplit('.', 1)[0])
+            jobs.append((os.path.join(current_dir, name), media))
+    return jobs
+
+
+def load_batch_manifest(manifest_path):
+    """读取批量任务清单
+
+    支持 JSON（[{"subtitle": ..., "media": ...}, ...]）和带表头的 CSV
+    （subtitle,media 两列）。相对路径相对于清单文件所在目录。
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8-sig', newline='') as f:
+        if manifest_path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+
+    jobs = []
+    for row in rows:
+        subtitle = row.get('subtitle')
+        if not subtitle:
+            continue
+        media = row.get('media') or None
+        jobs.append((
+            os.path.join(base_dir, subtitle),
+            os.path.join(base_dir, media) if media else None
+        ))
+    return jobs
+
+
+# 批量模式默认同时处理的文件数
+DEFAULT_PARALLEL_FILES = 3
+
+
+async def convert_batch(jobs, parallel_files=DEFAULT_PARALLEL_FILES,
+                        concurrency=DEFAULT_TTS_CONCURRENCY, overwrite=False,
+                        log=print, **options):
+    """批量转换多组字幕和媒体文件
+
+    所有文件共享同一个语音合成并发上限和限流状态，ffmpeg 与混音在线程池中
+    运行，因此一个文件在混音时其他文件仍在合成语音。已生成且比输入新的
+    输出会被跳过，中断后重新运行即可继续。返回 (字幕, 状态, 结果) 列表。
+    """
+    limiter = asyncio.Semaphore(max(1, concurrency))
+    throttle = TTSThrottle()
+    decoder = DecoderPool()
+    file_slots = asyncio.Semaphore(max(1, parallel_files))
+    total = len(jobs)
+
+    async def run(index, subtitle_path, media_path):
+        name = os.path.basename(subtitle_path)
+        if not overwrite and is_output_up_to_date(subtitle_path, media_path):
+            log(f"[{index}/{total}] 跳过已完成: {name}")
+            return subtitle_path, 'skipped', get_output_path(subtitle_path, media_path)
+
+        async with file_slots:
+            log(f"[{index}/{total}] 开始处理: {name}")
+            try:
+                output = await convert_subtitle_file(
+                    subtitle_path, media_path, concurrency=concurrency,
+                    log=lambda message: log(f"[{name}] {message}"),
+                    limiter=limiter, throttle=throttle, executor=executor,
+                    decoder=decoder, **options
+                )
+            except Exception as e:
+                log(f"[{index}/{total}] ❌ {name}: {str(e)}")
+                return subtitle_path, 'failed', e
+            return subtitle_path, 'done', output
+
+    try:
+        # 每个文件的混音在语音合成期间占用一个线程
+        workers = max(parallel_files + 1, os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return await asyncio.gather(*(
+                run(index, subtitle_path, media_path)
+                for index, (subtitle_path, media_path) in enumerate(jobs, 1)
+            ))
+    finally:
+        decoder.close()
+        if options.get('backend'):
+            await options['backend'].close()
+
+
+# 试听使用的文本
+PREVIEW_TEXT = "你好，我是你的语音模特。"
+
+
+class PreviewClip:
+    """一段试听语音，合成过程中就可以从头读取已经收到的数据"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._condition = threading.Condition()
+
+    def append(self, data):
+        with self._condition:
+            self.chunks.append(data)
+            self._condition.notify_all()
+
+    def finish(self, error=None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    @property
+    def data(self):
+        return b"".join(self.chunks)
+
+    def iter_chunks(self):
+        """依次返回音频块，合成未结束时等待后续数据，合成失败时抛出异常"""
+        position = 0
+        while True:
+            with self._condition:
+                while position >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+                if position >= len(self.chunks):
+                    if self.error:
+                        raise self.error
+                    return
+                chunk = self.chunks[position]
+            position += 1
+            yield chunk
+
+
+class VoicePreviewer:
+    """在后台线程中合成试听语音
+
+    get() 立即返回 PreviewClip，合成在独立线程的事件循环中进行，收到第一块
+    音频就可以开始播放，不阻塞界面。最近 max_clips 段试听保存在内存中
+    (LRU)，同一语音参数重复试听没有延迟；prewarm() 预先合成接下来可能
+    试听的语音，同时进行的预热请求不超过 prewarm_concurrency 个。
+    """
+
+    def __init__(self, backend=None, cache=None, max_clips=32, prewarm_concurrency=2,
+                 log=print):
+        self.backend = backend or create_tts_backend()
+        self.cache = cache
+        self.log = log
+        self.max_clips = max_clips
+        self.prewarm_concurrency = prewarm_concurrency
+        self.clips = OrderedDict()  # {缓存键: PreviewClip}
+        self._lock = threading.Lock()
+        self._prewarm_slots = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def get(self, voice, rate, volume, text=PREVIEW_TEXT, prewarm=False):
+        """返回试听语音，内存中没有时开始合成"""
+        key = segment_cache_key(text, voice, rate, volume, self.backend.version)
+        with self._lock:
+            clip = self.clips.get(key)
+            if clip is not None:
+                self.clips.move_to_end(key)
+                return clip
+            clip = self.clips[key] = PreviewClip()
+            while len(self.clips) > self.max_clips:
+                self.clips.popitem(last=False)
+        asyncio.run_coroutine_threadsafe(
+            self._synthesize(key, clip, text, voice, rate, volume, prewarm), self.loop
+        )
+        return clip
+
+    def prewarm(self, voices, rate, volume, text=PREVIEW_TEXT):
+        """在后台预先合成几个语音的试听"""
+        for voice in voices:
+            self.get(voice, rate, volume, text, prewarm=True)
+
+    async def _synthesize(self, key, clip, text, voice, rate, volume, prewarm):
+        try:
+            data = self.cache.read(key, self.backend.suffix) if self.cache else None
+            if data is not None:
+                clip.append(data)
+            else:
+                if self._prewarm_slots is None:
+                    self._prewarm_slots = asyncio.Semaphore(self.prewarm_concurrency)
+                async with self._prewarm_slots if prewarm else contextlib.nullcontext():
+                    async for chunk in self.backend.stream(text, voice, rate, volume):
+                        clip.append(chunk)
+                if not clip.chunks:
+                    raise ConversionError("生成预览音频失败")
+                if self.cache:
+                    try:
+                        self.cache.put_data(key, clip.data, self.backend.suffix)
+                    except OSError as e:
+                        self.log(f"写入语音缓存失败: {str(e)}")
+            clip.finish()
+        except Exception as e:
+            # 失败的试听不保留，下次重新合成
+            with self._lock:
+                if self.clips.get(key) is clip:
+                    del self.clips[key]
+            clip.finish(e)
+
+    def close(self):
+        # 先关闭保持着的连接，再停止事件循环
+        future = asyncio.run_coroutine_threadsafe(self.backend.close(), self.loop)
+        try:
+            future.result(timeout=2)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# 日志窗口最多显示的行数，完整日志写入日志文件
+LOG_MAX_LINES = 2000
+# 保留最近几次运行的日志文件
+LOG_KEEP_FILES = 10
+
+
+def create_log_file():
+    """在缓存目录下为本次运行新建日志文件，只保留最近 LOG_KEEP_FILES 个，返回路径"""
+    log_dir = os.path.join(get_cache_dir(), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    old_logs = sorted(name for name in os.listdir(log_dir) if name.endswith(".log"))
+    for name in old_logs[:max(0, len(old_logs) - LOG_KEEP_FILES + 1)]:
+        try:
+            os.remove(os.path.join(log_dir, name))
+        except OSError:
+            pass
+    return os.path.join(log_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.log")
+
+
+class UIEventChannel:
+    """工作线程向界面线程发送日志和进度的通道
+
+    任意线程都可以调用 log() 和 progress()，界面线程定时调用 drain() 一次
+    取出积累的日志和最新的进度，进度只保留最后一个值。界面来不及取走时
+    只保留最近 max_lines 行并记下省略的行数。传入 log_path 时每行日志同时
+    写入该文件。
+    """
+
+    def __init__(self, log_path=None, max_lines=LOG_MAX_LINES):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._lines = deque(maxlen=max_lines)
+        self._dropped = 0
+        self._progress = None
+        self._file = None
+        if log_path:
+            try:
+                self._file = open(log_path, 'a', encoding='utf-8', buffering=1)
+            except OSError as e:
+                print(f"无法创建日志文件: {str(e)}")
+
+    def log(self, message):
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(message)
+            if self._file:
+                try:
+                    self._file.write(message + "\n")
+                except (OSError, ValueError):
+                    self._file = None
+
+    def progress(self, value):
+        with self._lock:
+            self._progress = value
+
+    def drain(self):
+        """取出 (日志行列表, 省略的行数, 最新进度或 None)"""
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+            dropped, self._dropped = self._dropped, 0
+            progress, self._progress = self._progress, None
+        return lines, dropped, progress
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
 class SubtitleToSpeech:
     def __init__(self):
+        startup_start = time.perf_counter()
         self.window = tk.Tk()
         self.window.title("字幕转语音工具")
         self.window.withdraw()  # 先隐藏窗口
@@ -42,12 +3398,28 @@ class SubtitleToSpeech:
         self.window.minsize(850, 850)
         self.center_window(850, 850)
         
-        # 取可用的语音列表
-        self.voices = self.get_voice_list()
+        # 语音列表先从本地缓存读取，窗口显示后再在后台刷新
+        self.voice_catalog = VoiceCatalog()
+        self.voice_catalog.load_cached()
+        self.voice_refresh_thread = None
         
-        # 初始化音频播放器
-        mixer.init()
+        # 初始化音频播放器，pygame 只在图形界面中用到
+        from pygame import mixer
+        self.mixer = mixer
+        self.mixer.init()
         self.is_playing = False
+
+        # 语音片段缓存，转换与试听共用
+        self.segment_cache = SegmentCache()
+
+        # 混音用的片段存储区，每次转换复用同一个映射文件
+        self.segment_arena = SegmentArena()
+
+        # 试听在后台合成，边收边播
+        self.previewer = VoicePreviewer(cache=self.segment_cache, log=self.update_log)
+        self.preview_thread = None
+        self.preview_status = None
+        self.preview_error = None
         
         # 创建界面元素
         self.create_widgets()
@@ -55,19 +3427,72 @@ class SubtitleToSpeech:
         # 显示窗口
         self.window.deiconify()
         
-        # 添加日志队列和更新标志
-        self.log_queue = Queue()
-        self.is_updating_log = False
+        # 工作线程的日志和进度经由事件通道交给界面线程，完整日志写入文件
+        try:
+            log_path = create_log_file()
+        except OSError:
+            log_path = None
+        self.events = UIEventChannel(log_path)
         
         # 启动日志更新循环
-        self.window.after(100, self._process_log_queue)
+        self.window.after(100, self._process_events)
         
         # 添加一个变量来存储字幕文件路径
         self.subtitle_path = None
-    
-    def get_voice_list(self):
-        # 运行异步函数获取声音列表
-        return asyncio.run(edge_tts.list_voices())
+
+        self.update_log(f"界面启动耗时: {time.perf_counter() - startup_start:.2f}秒")
+        if log_path:
+            self.update_log(f"完整日志: {log_path}")
+
+        # 缓存过期或不存在时在后台获取语音列表
+        if self.voice_catalog.is_stale:
+            self.refresh_voices()
+        else:
+            self._prewarm_previews()
+
+    def refresh_voices(self):
+        """在后台线程中重新获取语音列表"""
+        if self.voice_refresh_thread and self.voice_refresh_thread.is_alive():
+            return
+        self.refresh_voice_btn.config(state='disabled')
+        self.update_log("正在获取语音列表...")
+
+        def run_refresh():
+            refresh_start = time.perf_counter()
+            try:
+                asyncio.run(self.voice_catalog.refresh())
+                self.update_log(f"✓ 语音列表已更新 (耗时: {time.perf_counter() - refresh_start:.1f}秒)")
+            except Exception as e:
+                self.update_log(f"⚠️ 获取语音列表失败: {str(e)}")
+
+        self.voice_refresh_thread = threading.Thread(target=run_refresh, daemon=True)
+        self.voice_refresh_thread.start()
+        self.window.after(100, self._check_voice_refresh)
+
+    def _check_voice_refresh(self):
+        """等待后台刷新结束后在界面线程中更新列表"""
+        if self.voice_refresh_thread.is_alive():
+            self.window.after(100, self._check_voice_refresh)
+            return
+        self.refresh_voice_btn.config(state='normal')
+        self._populate_voice_list()
+        self._prewarm_previews()
+
+    def _populate_voice_list(self):
+        """用语音目录填充列表，尽量保留当前选择"""
+        selection = self.voice_list.curselection()
+        selected = self.voice_list.get(selection[0]).split()[0] if selection else None
+
+        self.voice_list.delete(0, tk.END)
+        voice_choices = self._get_voice_choices()
+        for voice in voice_choices:
+            self.voice_list.insert(tk.END, voice)
+
+        index = next(
+            (i for i, choice in enumerate(voice_choices) if choice.split()[0] == selected), 0
+        )
+        self.voice_list.selection_set(index)
+        self.voice_list.see(index)
     
     def create_widgets(self):
         # 设置主题色和样式
@@ -181,12 +3606,10 @@ class SubtitleToSpeech:
         
         self.voice_list.config(yscrollcommand=scrollbar.set)
         scrollbar.config(command=self.voice_list.yview)
+        self.voice_list.bind("<<ListboxSelect>>", self._prewarm_previews)
         
         # 添加语音选项
-        voice_choices = self._get_voice_choices()
-        for voice in voice_choices:
-            self.voice_list.insert(tk.END, voice)
-        self.voice_list.selection_set(0)  # 默认选择第一个
+        self._populate_voice_list()
         
         # 试听按钮区域
         preview_frame = tk.Frame(voice_frame, bg=frame_bg)
@@ -213,6 +3636,17 @@ class SubtitleToSpeech:
             state='disabled'
         )
         self.stop_btn.pack(side=tk.LEFT, padx=5)
+
+        # 刷新语音列表按钮
+        self.refresh_voice_btn = tk.Button(
+            preview_frame,
+            text="刷新列表",
+            command=self.refresh_voices,
+            relief=tk.GROOVE,
+            cursor="hand2",
+            width=10
+        )
+        self.refresh_voice_btn.pack(side=tk.LEFT, padx=5)
         
         # 语音参数设置
         params_frame = tk.LabelFrame(
@@ -238,6 +3672,7 @@ class SubtitleToSpeech:
             state="readonly"
         )
         self.rate_menu.pack(side=tk.LEFT, padx=5)
+        self.rate_menu.bind("<<ComboboxSelected>>", self._prewarm_previews)
         
         # 音量设置
         volume_frame = tk.Frame(params_frame, bg=frame_bg)
@@ -253,7 +3688,24 @@ class SubtitleToSpeech:
             state="readonly"
         )
         self.volume_menu.pack(side=tk.LEFT, padx=5)
-        
+        self.volume_menu.bind("<<ComboboxSelected>>", self._prewarm_previews)
+
+        # 并发数设置
+        concurrency_frame = tk.Frame(params_frame, bg=frame_bg)
+        concurrency_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Label(concurrency_frame, text="并发数:", bg=frame_bg).pack(side=tk.LEFT)
+
+        self.concurrency_var = tk.IntVar(value=DEFAULT_TTS_CONCURRENCY)
+        self.concurrency_spin = ttk.Spinbox(
+            concurrency_frame,
+            textvariable=self.concurrency_var,
+            from_=1,
+            to=MAX_TTS_CONCURRENCY,
+            width=8,
+            state="readonly"
+        )
+        self.concurrency_spin.pack(side=tk.LEFT, padx=5)
+
         # 音量控制区域
         volume_frame = tk.LabelFrame(
             left_frame,  # 改为left_frame
@@ -335,44 +3787,18 @@ class SubtitleToSpeech:
     
     def _get_voice_choices(self):
         """获取语音选项"""
+        if not self.voice_catalog.voices:
+            return ["正在加载语音列表..."]
+
         voice_choices = []
-        for v in self.voices:
-            try:
-                if 'zh' in v['Locale'].lower():
-                    name = v.get('FriendlyName', v.get('Name', ''))
-                    short_name = v.get('ShortName', '')
-                    voice_choices.append(f"{short_name} ({name})")
-            except Exception as e:
-                print(f"处理语音信息时出错: {str(e)}")
-                continue
-        
+        for v in self.voice_catalog.find(locale='zh'):
+            name = v.get('FriendlyName', v.get('Name', ''))
+            voice_choices.append(f"{v['ShortName']} ({name})")
+
         return voice_choices if voice_choices else ["未找到中文语音"]
     
-    async def convert_text_to_speech(self, text, output_file, voice, rate, volume):
-        max_retries = 3  # 最大重试次数
-        retry_delay = 1  # 重试延迟（秒）
-        
-        for attempt in range(max_retries):
-            try:
-                communicate = edge_tts.Communicate(
-                    text, 
-                    voice,
-                    rate=rate,
-                    volume=volume
-                )
-                await communicate.save(output_file)
-                return  # 成功则直接返回
-                
-            except Exception as e:
-                if attempt < max_retries - 1:  # 如果还有重试机会
-                    print(f"语音生成失败{retry_delay}秒后重试: {str(e)}")
-                    await asyncio.sleep(retry_delay)
-                    retry_delay *= 2  # 增加重试延迟
-                else:  # 最后一次尝试失败
-                    raise  # 重新抛出异常
-    
-    def _start_conversion_thread(self):
-        """在新线程中启动转换过程"""
+    def _start_conversion_thread(self, options):
+        """在新线程中启动转换过程，options 为界面线程中读取好的参数"""
         self.convert_btn.config(state='disabled')
         
         def run_async():
@@ -382,7 +3808,7 @@ class SubtitleToSpeech:
                 asyncio.set_event_loop(loop)
                 
                 # 运行转换任务
-                loop.run_until_complete(self.convert_subtitle())
+                loop.run_until_complete(self.convert_subtitle(**options))
             except Exception as e:
                 self.update_log(f"❌ 转换失败: {str(e)}")
             finally:
@@ -418,259 +3844,75 @@ class SubtitleToSpeech:
         
         self.window.after(100, check_thread)
     
-    def start_conversion(self):
-        """启动转换过程"""
-        self._start_conversion_thread()
-    
-    async def convert_subtitle(self):
-        total_start_time = datetime.now()
-        
+    def _conversion_options(self):
+        """在界面线程中读取转换参数，缺少必要的选择时提示并返回 None"""
         subtitle_path = self.file_label.cget("text")
         media_path = self.media_label.cget("text")
-        
+
         if subtitle_path == "未选择文件":
             self.show_message("错误", "请先选择字幕文件!")
+            return None
+
+        # 获取选择的语音
+        selection = self.voice_list.curselection()
+        voice_full = self.voice_list.get(selection[0]) if selection else ""
+        voice = voice_full.split()[0] if voice_full else None
+        if not voice or not self.voice_catalog.get(voice):
+            self.show_message("错误", "请选择语音!")
+            return None
+
+        try:
+            concurrency = int(self.concurrency_var.get())
+        except (tk.TclError, ValueError):
+            concurrency = DEFAULT_TTS_CONCURRENCY
+        concurrency = max(1, min(MAX_TTS_CONCURRENCY, concurrency))
+
+        return {
+            'subtitle_path': subtitle_path,
+            'media_path': media_path if media_path != "未选择文件" else None,
+            'voice': voice,
+            'rate': self.rate_var.get(),
+            'volume': self.volume_var.get(),
+            'bg_volume': self.bg_volume_scale.get(),
+            'concurrency': concurrency,
+        }
+
+    def start_conversion(self):
+        """启动转换过程"""
+        # 工作线程不访问 Tk 控件，参数在这里一次读取好
+        options = self._conversion_options()
+        if options:
+            self._start_conversion_thread(options)
+    
+    async def convert_subtitle(self, subtitle_path, media_path, voice, rate, volume, bg_volume,
+                               concurrency):
+        total_start_time = datetime.now()
+        try:
+            output = await convert_subtitle_file(
+                subtitle_path,
+                media_path,
+                voice=voice,
+                rate=rate,
+                volume=volume,
+                bg_volume=bg_volume,
+                concurrency=concurrency,
+                cache=self.segment_cache,
+                arena=self.segment_arena,
+                log=self.update_log,
+                progress=self.events.progress
+            )
+        except ConversionError as e:
+            self.show_message("错误", str(e))
             return
-        
-        # 检查是否选择了视频文件
-        is_video = media_path.lower().endswith(('.mp4', '.mkv', '.avi', '.mov'))
-        
-        # 创建一个主临时目录
-        with tempfile.TemporaryDirectory() as main_temp_dir:
-            try:
-                # 加载字幕文件
-                try:
-                    subs = pysubs2.load(subtitle_path)
-                except Exception as e:
-                    self.show_message("错误", f"读取字幕文件失败: {str(e)}")
-                    return
-                
-                # 果选择了视频，提取音频
-                if is_video:
-                    extract_start = datetime.now()
-                    self.update_log("正在提取视频音频...")
-                    
-                    # 在主临时目录中创建音频文件
-                    temp_audio = os.path.join(main_temp_dir, "extracted_audio.mp3")
-                    
-                    # 使用ffmpeg提取音频
-                    command = [
-                        'ffmpeg',
-                        '-i', media_path,
-                        '-vn',  # 不处理视频
-                        '-acodec', 'libmp3lame',
-                        '-q:a', '0',  # 最高质量
-                        '-y',  # 覆盖已存在的文件
-                        temp_audio
-                    ]
-                    
-                    process = subprocess.Popen(
-                        command,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE
-                    )
-                    
-                    stdout, stderr = process.communicate()
-                    
-                    if process.returncode == 0:
-                        # 提取成功，更新音频路径
-                        audio_path = temp_audio
-                    else:
-                        raise Exception(f"提取音频失败: {stderr.decode()}")
-                    
-                    self.update_log(f"✓ 音频提取完成 (耗时: {format_time_delta(extract_start)})")
-                else:
-                    audio_path = media_path
-                
-                # 获选择的语音
-                voice_full = self.voice_list.get(self.voice_list.curselection())
-                voice = voice_full.split()[0] if voice_full else None
-                if not voice:
-                    self.show_message("错误", "请选择语音!")
-                    return
-                
-                rate = self.rate_var.get()
-                volume = self.volume_var.get()
-                
-                # 创建语音片段的临时目录
-                speech_temp_dir = os.path.join(main_temp_dir, "speech_segments")
-                os.makedirs(speech_temp_dir, exist_ok=True)
-                
-                # 转换字幕
-                convert_start = datetime.now()
-                total = len(subs)
-                self.update_log(f"开始转换 {total} 条字幕...")
-                
-                audio_segments = []
-                
-                # 重置进度条
-                self.progress_var.set(0)
-                
-                for i, line in enumerate(subs):
-                    text = line.text.strip()
-                    if not text:
-                        continue
-                        
-                    try:
-                        # 生成语音文件
-                        temp_file = os.path.join(speech_temp_dir, f"speech_{i+1}.mp3")
-                        try:
-                            await self.convert_text_to_speech(text, temp_file, voice, rate, volume)
-                        except Exception as e:
-                            self.update_log(f"警告: 转换失败，正在重试...")
-                            continue
-                        
-                        # 等待文件生成完成
-                        while not os.path.exists(temp_file):
-                            await asyncio.sleep(0.1)
-                        
-                        # 读取音频片段
-                        audio_segment = AudioSegment.from_mp3(temp_file)
-                        
-                        # 调整音频长度以匹配字幕持续时间
-                        subtitle_duration = line.end - line.start
-                        
-                        if len(audio_segment) > subtitle_duration:
-                            speed_factor = len(audio_segment) / subtitle_duration
-                            audio_segment = audio_segment.speedup(playback_speed=speed_factor)
-                        elif len(audio_segment) < subtitle_duration:
-                            silence_duration = subtitle_duration - len(audio_segment)
-                            audio_segment = audio_segment + AudioSegment.silent(duration=silence_duration)
-                        
-                        audio_segment = audio_segment[0:subtitle_duration]
-                        
-                        audio_segments.append({
-                            'start': line.start,
-                            'audio': audio_segment,
-                            'text': text
-                        })
-                        
-                    except Exception as e:
-                        self.update_log(f"⚠️ 转换失败: {str(e)}")
-                        continue
-                    
-                    # 只更新进度条，不显示进度信息
-                    self.progress_var.set((i + 1) / total * 100)
-                
-                self.update_log(f"✓ 字幕转换完成 (耗时: {format_time_delta(convert_start)})")
-                
-                try:
-                    if not audio_segments:
-                        raise Exception("没有成功转换任何音频片段")
-                    
-                    # 创建完整的配音音频
-                    final_duration = max(segment['start'] + len(segment['audio']) 
-                                      for segment in audio_segments) + 1000
-                    dubbed_audio = AudioSegment.silent(duration=final_duration)
-                    
-                    # 合并所有配音片段
-                    for segment in audio_segments:
-                        dubbed_audio = dubbed_audio.overlay(
-                            segment['audio'], 
-                            position=segment['start'],
-                            gain_during_overlay=-1  # 轻微降低重叠部分的音量
-                        )
-                    
-                    # 创建输出目录
-                    output_dir = os.path.join(os.path.dirname(subtitle_path), "speech_output")
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-                    
-                    # 如果有背景音频，行混音
-                    if audio_path and audio_path != "未选择文件":
-                        mix_start = datetime.now()
-                        self.update_log("正在混合音频...")
-                        
-                        # 读取背景音频
-                        background_audio = AudioSegment.from_file(
-                            audio_path,
-                            format="mp3",
-                            parameters=["-bufsize", "10M"]
-                        )
-                        
-                        # 调整背景音量
-                        bg_volume = self.bg_volume_scale.get() / 100.0
-                        background_audio = background_audio - (20 * (1 - bg_volume))
-                        
-                        # 确保背景音频足够长
-                        if len(background_audio) < len(dubbed_audio):
-                            times_to_repeat = (len(dubbed_audio) // len(background_audio)) + 1
-                            background_audio = background_audio * times_to_repeat
-                        
-                        # 裁剪到需要的长度
-                        background_audio = background_audio[:len(dubbed_audio)]
-                        
-                        # 合并音频
-                        final_audio = background_audio.overlay(dubbed_audio)
-                    else:
-                        final_audio = dubbed_audio
-                    
-                    # 生成输出件名（原始文件所在目录）
-                    input_name = os.path.splitext(media_path)[0]  # 获取带扩展名的原始文件名
-                    
-                    # 保存音频文件
-                    audio_output = f"{input_name}_s.mp3"
-                    final_audio.export(
-                        audio_output,
-                        format="mp3",
-                        parameters=["-q:a", "0", "-ar", "44100", "-b:a", "192k"]
-                    )
-                    
-                    # 如果是视频文件，创建新的视频
-                    if is_video:
-                        video_start = datetime.now()
-                        self.update_log("正在生成最终视频...")
-                        
-                        # 使用原始文件名加上_s后缀
-                        output_video = f"{input_name}_s.mp4"
-                        
-                        command = [
-                            'ffmpeg',
-                            '-i', media_path,  # 原视频
-                            '-i', audio_output,  # 混合后的音频
-                            '-c:v', 'copy',  # 复制视频流
-                            '-c:a', 'aac',  # 音频编码
-                            '-strict', 'experimental',
-                            '-map', '0:v:0',  # 使用第一个输入的视频流
-                            '-map', '1:a:0',  # 使用第二个输入的音频流
-                            '-y',  # 覆盖已存在的文件
-                            output_video
-                        ]
-                        
-                        process = subprocess.Popen(
-                            command,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
-                        )
-                        
-                        stdout, stderr = process.communicate()
-                        
-                        if process.returncode != 0:
-                            raise Exception(f"生成视频失败: {stderr.decode()}")
-                    
-                    self.update_log(f"✓ 视频生成完成 (耗时: {format_time_delta(video_start)})")
-                    
-                    # 显示总耗时
-                    self.update_log(f"\n✨ 全部处理完成！总耗时: {format_time_delta(total_start_time)}")
-                    
-                    if is_video:
-                        self.show_message("完成", f"视频转换完成!\n保存为: {output_video}\n总耗时: {format_time_delta(total_start_time)}")
-                    else:
-                        self.show_message("完成", f"音频转换完成!\n保存为: {audio_output}\n总耗时: {format_time_delta(total_start_time)}")
-                    
-                except Exception as e:
-                    self.show_message("错误", f"处理失败: {str(e)}")
-                    return
-                
-            except Exception as e:
-                self.show_message("错误", f"转换失败: {str(e)}")
-                return
-        
+        except Exception as e:
+            self.show_message("错误", f"转换失败: {str(e)}")
+            return
+
+        kind = "视频" if output.lower().endswith(VIDEO_EXTENSIONS) else "音频"
+        self.show_message("完成", f"{kind}转换完成!\n保存为: {output}\n总耗时: {format_time_delta(total_start_time)}")
+
         # 完成后清理临时文件
         self.cleanup_temp_files()
-        
-        # 在处理大量音频片段后主动进行垃圾回收
-        gc.collect()
     
     def select_file(self):
         file_path = filedialog.askopenfilename(
@@ -697,34 +3939,85 @@ class SubtitleToSpeech:
             self.media_label.config(text=file_path)
     
     def stop_preview(self):
-        """停止试听"""
-        if self.is_playing:
-            mixer.music.stop()
-            self.is_playing = False
-            self.preview_btn.config(state='normal')
-            self.stop_btn.config(state='disabled')
-    
-    def play_preview(self, preview_file):
-        """在新线程中播放预览音频"""
+        """停止试听，按钮状态由 _check_preview 恢复"""
+        self.is_playing = False
+
+    def play_preview(self, clip):
+        """在后台线程中边解码边播放试听语音，收到第一块音频就开始播放"""
+        sample_rate, _, channels = self.mixer.get_init()
+        decoder = open_pcm_decoder('pipe:0', loop=False, sample_rate=sample_rate,
+                                   channels=channels)
+
+        def feed():
+            try:
+                for chunk in clip.iter_chunks():
+                    decoder.stdin.write(chunk)
+                    decoder.stdin.flush()
+            except OSError:
+                # 停止试听后解码进程已结束
+                pass
+            except Exception as e:
+                self.preview_error = e
+            finally:
+                try:
+                    decoder.stdin.close()
+                except OSError:
+                    pass
+
+        threading.Thread(target=feed, daemon=True).start()
+        channel = self.mixer.Channel(0)
+        block_bytes = sample_rate * channels * 2 // 5  # 每次送入 0.2 秒
         try:
-            mixer.music.load(preview_file)
-            mixer.music.play()
-            self.is_playing = True
-            
+            while self.is_playing:
+                data = read_exact(decoder.stdout, block_bytes)
+                if not data:
+                    break
+                self.preview_status = "播放中..."
+                sound = self.mixer.Sound(buffer=data)
+                # 通道只能排队一段，上一段开始播放后再排入下一段
+                while self.is_playing and channel.get_queue() is not None:
+                    time.sleep(0.01)
+                if channel.get_busy():
+                    channel.queue(sound)
+                else:
+                    channel.play(sound)
+
             # 等待播放完成
-            while mixer.music.get_busy():
-                time.sleep(0.1)
-            
-            # 播放完成后恢复按钮状态
-            self.is_playing = False
-            self.preview_btn.config(state='normal')
-            self.stop_btn.config(state='disabled')
-            
+            while self.is_playing and channel.get_busy():
+                time.sleep(0.05)
         except Exception as e:
-            print(f"播放音频失败: {str(e)}")
-            self.preview_btn.config(state='normal')
-            self.stop_btn.config(state='disabled')
-    
+            self.preview_error = e
+        finally:
+            channel.stop()
+            decoder.kill()
+            decoder.wait()
+            decoder.error_log.close()
+            self.is_playing = False
+
+    def _check_preview(self):
+        """在界面线程中跟随试听进度更新按钮"""
+        if self.preview_thread.is_alive():
+            self.preview_btn.config(text=self.preview_status)
+            self.window.after(100, self._check_preview)
+            return
+        self.preview_btn.config(state='normal', text="试听语音")
+        self.stop_btn.config(state='disabled')
+        if self.preview_error:
+            self.show_message("错误", f"试听失败: {str(self.preview_error)}")
+
+    def _prewarm_previews(self, event=None):
+        """在后台预先合成选中的语音及其相邻语音的试听"""
+        selection = self.voice_list.curselection()
+        if not selection:
+            return
+        voices = []
+        for i in (selection[0], selection[0] - 1, selection[0] + 1):
+            if 0 <= i < self.voice_list.size():
+                voice = self.voice_list.get(i).split()[0]
+                if self.voice_catalog.get(voice):
+                    voices.append(voice)
+        self.previewer.prewarm(voices, self.rate_var.get(), self.volume_var.get())
+
     def preview_voice(self):
         """试听当前选择的语音"""
         selection = self.voice_list.curselection()
@@ -734,67 +4027,43 @@ class SubtitleToSpeech:
         
         voice_full = self.voice_list.get(selection[0])
         voice = voice_full.split()[0]
-        
-        # 禁试听按钮，启用停止按钮
-        self.preview_btn.config(state='disabled')
+        if not self.voice_catalog.get(voice):
+            self.show_message("错误", "语音列表尚未加载完成!")
+            return
+        if self.preview_thread and self.preview_thread.is_alive():
+            return
+
+        # 同一语音参数的试听直接从内存播放，否则在后台合成
+        clip = self.previewer.get(voice, self.rate_var.get(), self.volume_var.get())
+        self.preview_status = "播放中..." if clip.done else "生成中..."
+        self.preview_error = None
+        self.is_playing = True
+
+        # 禁用试听按钮，启用停止按钮
+        self.preview_btn.config(state='disabled', text=self.preview_status)
         self.stop_btn.config(state='normal')
-        self.preview_btn.config(text="生成中...")
-        self.window.update()
-        
-        try:
-            # 创建临时目录
-            with tempfile.TemporaryDirectory() as temp_dir:
-                preview_file = os.path.join(temp_dir, "preview.mp3")
-                
-                # 获取当前设置
-                rate = self.rate_var.get()
-                volume = self.volume_var.get()
-                
-                # 生成语音
-                asyncio.run(self.convert_text_to_speech(
-                    "你好，我是你的语音模特。", 
-                    preview_file,
-                    voice,
-                    rate,
-                    volume
-                ))
-                
-                # 等待文件生成并确认文件存在
-                max_wait = 50
-                while not os.path.exists(preview_file) and max_wait > 0:
-                    time.sleep(0.1)
-                    max_wait -= 1
-                
-                if os.path.exists(preview_file) and os.path.getsize(preview_file) > 0:
-                    # 复制到临时文件
-                    temp_preview = os.path.join(tempfile.gettempdir(), "voice_preview.mp3")
-                    import shutil
-                    shutil.copy2(preview_file, temp_preview)
-                    
-                    # 在新线程中播放音频
-                    self.preview_btn.config(text="播放中...")
-                    threading.Thread(
-                        target=self.play_preview,
-                        args=(temp_preview,),
-                        daemon=True
-                    ).start()
-                else:
-                    raise Exception("生成预览音频失败")
-        except Exception as e:
-            self.show_message("错误", f"试听失败: {str(e)}")
-            self.preview_btn.config(state='normal')
-            self.stop_btn.config(state='disabled')
-            self.preview_btn.config(text="试听语音")
+
+        self.preview_thread = threading.Thread(
+            target=self.play_preview,
+            args=(clip,),
+            daemon=True
+        )
+        self.preview_thread.start()
+        self.window.after(100, self._check_preview)
     
     def update_log(self, message):
-        """将日志消息添加到队列"""
-        self.log_queue.put(message)
+        """记录一条日志，可以在任意线程中调用"""
+        self.events.log(message)
     
     def run(self):
         try:
             self.window.mainloop()
         finally:
             # 清理资源
+            self.is_playing = False
+            self.previewer.close()
+            self.events.close()
+            self.segment_arena.close()
             self.cleanup_temp_files()
             
             # 确保所有线程都已终止
@@ -808,7 +4077,6 @@ class SubtitleToSpeech:
             if self.subtitle_path:  # 使用保存的路径
                 temp_dir = os.path.join(os.path.dirname(self.subtitle_path), "speech_output")
                 if os.path.exists(temp_dir):
-                    import shutil
                     shutil.rmtree(temp_dir)
         except Exception as e:
             print(f"清理临时文件失败: {str(e)}")
@@ -835,20 +4103,24 @@ class SubtitleToSpeech:
             self.update_log(f"[{timestamp}] ✅ {message}")
         else:
             self.update_log(f"[{timestamp}] ℹ️ {message}")
-        self.window.update()
     
-    def _process_log_queue(self):
-        """处理日志队列"""
-        if not self.is_updating_log:
-            self.is_updating_log = True
-            while not self.log_queue.empty():
-                message = self.log_queue.get()
-                self.log_text.insert(tk.END, message + "\n")
-                self.log_text.see(tk.END)
-            self.is_updating_log = False
+    def _process_events(self):
+        """在界面线程中一次显示积累的日志并更新进度"""
+        lines, dropped, progress = self.events.drain()
+        if progress is not None:
+            self.progress_var.set(progress)
+        if lines:
+            if dropped:
+                lines.insert(0, f"... 省略 {dropped} 行，完整内容见日志文件")
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 只保留最近 LOG_MAX_LINES 行
+            line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+            if line_count > LOG_MAX_LINES:
+                self.log_text.delete('1.0', f"{line_count - LOG_MAX_LINES + 1}.0")
+            self.log_text.see(tk.END)
         
         # 继续循环
-        self.window.after(100, self._process_log_queue)
+        self.window.after(100, self._process_events)
 
 def format_time_delta(start_time):
     """计算并格式化耗时"""
@@ -863,6 +4135,176 @@ def format_time_delta(start_time):
         hours = seconds / 3600
         return f"{hours:.1f}小时"
 
+
+def build_arg_parser():
+    """命令行参数定义"""
+    parser = argparse.ArgumentParser(
+        prog="subtitle_to_speech",
+        description="将字幕转换为配音。不带参数运行时打开图形界面。"
+    )
+    parser.add_argument("subtitle", nargs="?", help="字幕文件 (.srt / .ass)")
+    parser.add_argument("-m", "--media", help="视频或音频文件，作为背景音频并生成配音视频")
+    parser.add_argument("--voice", default=DEFAULT_VOICE, help=f"语音名称 (默认 {DEFAULT_VOICE})")
+    parser.add_argument("--rate", default="+0%", help="语速，例如 +25%% (默认 +0%%)")
+    parser.add_argument("--volume", default="+0%", help="音量，例如 -25%% (默认 +0%%)")
+    parser.add_argument("--bg-volume", type=int, default=5,
+                        help="原始音频音量百分比 0-100 (默认 5)")
+    parser.add_argument("--bg-gap-volume", type=int, metavar="PCT",
+                        help="对白之间的原始音频音量百分比 0-100，设置后 --bg-volume 只用于"
+                             "对白期间，原始音频在对白前后平滑地压低和恢复")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_TTS_CONCURRENCY,
+                        help=f"同时进行的语音合成请求数 (默认 {DEFAULT_TTS_CONCURRENCY})")
+    parser.add_argument("--no-cache", action="store_true", help="不读取也不写入语音片段缓存")
+    parser.add_argument("--backend", choices=sorted(TTS_BACKENDS), default=DEFAULT_TTS_BACKEND,
+                        help="语音合成后端，local 为离线的模拟后端 (默认 edge)")
+    parser.add_argument("--local-latency", type=float, default=0.0,
+                        help="local 后端每次请求的模拟延迟（秒）")
+    parser.add_argument("--local-failure-rate", type=float, default=0.0,
+                        help="local 后端注入失败的概率 0-1")
+    parser.add_argument("--time-stretch", choices=sorted(TIME_STRETCH_ENGINES),
+                        default=DEFAULT_TIME_STRETCH,
+                        help=f"语音过长时的变速引擎 (默认 {DEFAULT_TIME_STRETCH})")
+    parser.add_argument("--resynth-threshold", type=float, default=DEFAULT_RESYNTH_THRESHOLD,
+                        help="需要加速超过该倍数时用更快的语速重新合成，0 表示不重新合成 "
+                             f"(默认 {DEFAULT_RESYNTH_THRESHOLD})")
+    parser.add_argument("--group-cues", type=int, default=0, metavar="N",
+                        help="把最多 N 条相邻字幕合成为一次请求，再按词边界切回各条，"
+                             "适合短句很多的字幕 (默认 0 表示逐条合成)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="在输出文件旁保存工程目录，修改字幕后再次转换只重新渲染变化的部分")
+    parser.add_argument("--no-checkpoint", action="store_true",
+                        help="不在输出文件旁保存任务目录 (_s.job)，中断后无法继续")
+    parser.add_argument("--resume", action="store_true",
+                        help="从任务目录继续上次中断的转换，只重新处理失败或缺失的字幕")
+    parser.add_argument("--no-audio-file", action="store_true",
+                        help="处理视频时只生成 _s.mp4，不额外输出 _s.mp3")
+    parser.add_argument("--list-voices", action="store_true",
+                        help="列出可用语音后退出（优先使用本地缓存）")
+    parser.add_argument("--refresh-voices", action="store_true",
+                        help="重新获取语音列表并更新本地缓存")
+    parser.add_argument("--locale", help="列出语音时按地区筛选，例如 zh 或 zh-CN")
+    parser.add_argument("--gender", help="列出语音时按性别筛选 (Female / Male)")
+
+    profile = parser.add_argument_group("性能分析")
+    profile.add_argument("--metrics", metavar="FILE",
+                         help="保存各阶段耗时、合成延迟、数据量等统计 (.json 或 .csv)")
+    profile.add_argument("--profile", metavar="FILE",
+                         help="用 cProfile 分析整个运行过程并保存结果")
+    profile.add_argument("--tracemalloc", action="store_true",
+                         help="统计 Python 内存分配，结束后输出分配最多的代码行")
+
+    batch = parser.add_argument_group("批量模式")
+    batch.add_argument("--batch", metavar="DIR",
+                       help="处理目录树中所有同名的字幕和视频/音频文件")
+    batch.add_argument("--manifest", metavar="FILE",
+                       help="按 JSON/CSV 清单批量处理 (字段 subtitle, media)")
+    batch.add_argument("--parallel-files", type=int, default=DEFAULT_PARALLEL_FILES,
+                       help=f"同时处理的文件数 (默认 {DEFAULT_PARALLEL_FILES})")
+    batch.add_argument("--overwrite", action="store_true",
+                       help="重新生成已完成的输出文件")
+    return parser
+
+
+def run_batch_cli(args, options):
+    """执行命令行批量模式，返回退出码"""
+    if args.manifest:
+        jobs = load_batch_manifest(args.manifest)
+    else:
+        jobs = find_batch_jobs(args.batch)
+    if not jobs:
+        print("没有找到字幕文件", file=sys.stderr)
+        return 1
+
+    batch_start = datetime.now()
+    results = asyncio.run(convert_batch(
+        jobs,
+        parallel_files=args.parallel_files,
+        overwrite=args.overwrite,
+        **options
+    ))
+
+    done = sum(1 for _, status, _ in results if status == 'done')
+    skipped = sum(1 for _, status, _ in results if status == 'skipped')
+    failed = [(path, error) for path, status, error in results if status == 'failed']
+    print(f"\n批量处理完成: 成功 {done}，跳过 {skipped}，失败 {len(failed)} "
+          f"(总耗时: {format_time_delta(batch_start)})")
+    for path, error in failed:
+        print(f"  ❌ {path}: {str(error)}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    """命令行入口，不创建任何窗口"""
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+
+    concurrency = max(1, min(MAX_TTS_CONCURRENCY, args.concurrency))
+    if args.backend == LocalTTSBackend.name:
+        backend = create_tts_backend(
+            args.backend,
+            latency=args.local_latency,
+            failure_rate=args.local_failure_rate
+        )
+    else:
+        # 连接池与并发数一致，每个并发请求各占一条复用的连接
+        backend = create_tts_backend(args.backend, pool_size=concurrency)
+
+    if args.list_voices or args.refresh_voices:
+        catalog = VoiceCatalog(backend)
+        try:
+            if args.refresh_voices:
+                asyncio.run(catalog.refresh())
+            else:
+                asyncio.run(catalog.ensure_loaded())
+        except Exception as e:
+            print(f"❌ 获取语音列表失败: {str(e)}", file=sys.stderr)
+            return 1
+        for v in catalog.find(locale=args.locale, gender=args.gender):
+            print(f"{v.get('ShortName', '')}\t{v.get('Locale', '')}\t{v.get('Gender', '')}")
+        return 0
+
+    options = dict(
+        voice=args.voice,
+        rate=args.rate,
+        volume=args.volume,
+        bg_volume=max(0, min(100, args.bg_volume)),
+        bg_gap_volume=None if args.bg_gap_volume is None else max(0, min(100, args.bg_gap_volume)),
+        concurrency=concurrency,
+        cache=None if args.no_cache else SegmentCache(),
+        keep_audio=not args.no_audio_file,
+        incremental=args.incremental,
+        checkpoint=not args.no_checkpoint,
+        resume=args.resume,
+        time_stretch=args.time_stretch,
+        resynth_threshold=args.resynth_threshold or None,
+        group_cues=args.group_cues,
+        backend=backend
+    )
+
+    if not (args.subtitle or args.batch or args.manifest):
+        parser.error("请指定字幕文件，或使用 --batch / --manifest")
+
+    # 批量模式下所有文件的统计累加到同一份结果中
+    metrics = PipelineMetrics()
+    options['metrics'] = metrics
+    try:
+        with profiling(args.profile, args.tracemalloc):
+            if args.batch or args.manifest:
+                return run_batch_cli(args, options)
+            output = convert_subtitle_headless(args.subtitle, args.media, **options)
+    except ConversionError as e:
+        print(f"❌ {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+            print(f"统计结果已保存: {args.metrics}")
+    print(f"✅ 已保存为: {output}")
+    return 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main())
     app = SubtitleToSpeech()
-    app.run() 
\ No newline at end of file
+    app.run()
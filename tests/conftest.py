@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 被测模块是仓库根目录下的单个脚本
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,96 @@
+"""合并合成：按词边界切回各条字幕，词边界对不上时退回逐条合成"""
+import asyncio
+import io
+import wave
+
+import numpy as np
+import pytest
+
+import subtitle_to_speech as sts
+
+VOICE = "zh-CN-LocalFemaleNeural"
+TEXTS = ["你好", "今天天气不错", "再见"]
+
+
+class MissingWordBackend(sts.LocalTTSBackend):
+    """词边界中缺少某些字的本地后端"""
+
+    def __init__(self, missing):
+        super().__init__()
+        self.missing = set(missing)
+
+    async def synthesize_with_boundaries(self, text, voice, rate, volume):
+        data, boundaries = await super().synthesize_with_boundaries(text, voice, rate, volume)
+        return data, [b for b in boundaries if b[2] not in self.missing]
+
+
+def wav_samples(data):
+    with wave.open(io.BytesIO(data)) as f:
+        return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+
+
+def test_split_follows_word_boundaries():
+    backend = sts.LocalTTSBackend()
+    text, ranges = sts.join_group_text(TEXTS)
+    boundaries = []
+    samples = backend.render(text, VOICE, boundaries=boundaries)
+
+    pieces = sts.split_group_audio(samples, backend.sample_rate, boundaries, text, ranges)
+
+    syllable = int(backend.sample_rate / backend.chars_per_second)
+    padding = sts.GROUP_SPLIT_PADDING_MS * backend.sample_rate // 1000
+    assert len(pieces) == len(TEXTS)
+    for n, (piece, cue) in enumerate(zip(pieces, TEXTS)):
+        # 第一条从音频开头切起，其余各条在首词之前保留 padding 的静音
+        lead = 0 if n == 0 else padding
+        assert len(piece) == lead + len(cue) * syllable + padding
+        # 切出的语音与单独合成这条字幕的语音相同
+        alone = backend.render(cue, VOICE)
+        assert np.array_equal(piece[lead:lead + len(cue) * syllable], alone[:len(cue) * syllable])
+
+
+def test_split_rejects_cue_without_words():
+    backend = sts.LocalTTSBackend()
+    text, ranges = sts.join_group_text(TEXTS)
+    boundaries = []
+    samples = backend.render(text, VOICE, boundaries=boundaries)
+    boundaries = [b for b in boundaries if b[2] not in TEXTS[1]]
+
+    with pytest.raises(sts.ConversionError):
+        sts.split_group_audio(samples, backend.sample_rate, boundaries, text, ranges)
+
+
+def synthesize(backend, logs):
+    metrics = sts.PipelineMetrics()
+    results = asyncio.run(sts.synthesize_lines(
+        list(enumerate(TEXTS)), VOICE, "+0%", "+0%", 2,
+        backend=backend, metrics=metrics, group_cues=len(TEXTS), log=logs.append
+    ))
+    return results, metrics
+
+
+def test_grouped_synthesis_returns_split_pieces():
+    backend = sts.LocalTTSBackend()
+    logs = []
+    results, metrics = synthesize(backend, logs)
+
+    assert metrics.counters['grouped_requests'] == 1
+    assert metrics.counters['grouped_cues'] == len(TEXTS)
+    assert not logs
+    text, ranges = sts.join_group_text(TEXTS)
+    boundaries = []
+    samples = backend.render(text, VOICE, boundaries=boundaries)
+    expected = sts.split_group_audio(samples, backend.sample_rate, boundaries, text, ranges)
+    for data, piece in zip(results, expected):
+        assert np.array_equal(wav_samples(data), piece)
+
+
+def test_missing_word_falls_back_to_per_cue_synthesis():
+    backend = MissingWordBackend(TEXTS[1])
+    logs = []
+    results, metrics = synthesize(backend, logs)
+
+    assert 'grouped_requests' not in metrics.counters
+    assert any("合并合成失败，改为逐条合成" in message for message in logs)
+    for data, cue in zip(results, TEXTS):
+        assert np.array_equal(wav_samples(data), backend.render(cue, VOICE))
@@ -0,0 +1,121 @@
+"""增量渲染：MP3 帧解析和工程音轨的局部替换"""
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import subtitle_to_speech as sts
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="需要 ffmpeg")
+
+
+def mp3_header(version=3, bitrate_index=9, rate_index=0, padding=0, mono=False):
+    """构造一个 Layer III 帧头 (不带 CRC)"""
+    header = (0x7ff << 21 | version << 19 | 1 << 17 | 1 << 16 | bitrate_index << 12
+              | rate_index << 10 | padding << 9 | (3 if mono else 0) << 6)
+    return header.to_bytes(4, 'big')
+
+
+def mp3_frame(**fields):
+    data = mp3_header(**fields)
+    length = sts.parse_mp3_header(data, 0)[0]
+    return data + bytes(length - 4)
+
+
+def tone(freq, ms, amplitude=8000):
+    t = np.arange(int(sts.OUTPUT_SAMPLE_RATE * ms / 1000)) / sts.OUTPUT_SAMPLE_RATE
+    return (np.sin(2 * np.pi * freq * t) * amplitude).astype(np.int16)
+
+
+def decode(path):
+    process = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path, '-f', 's16le', 'pipe:1'],
+                             stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(process.stdout, dtype=np.int16).astype(np.int32)
+
+
+@pytest.mark.parametrize("fields, expected", [
+    # MPEG-1 128 kbps 44.1 kHz：144 * 128000 / 44100 = 417.9，填充位再加一字节
+    (dict(bitrate_index=9, rate_index=0), (417, 1152, 44100, 2, 32)),
+    (dict(bitrate_index=9, rate_index=0, padding=1), (418, 1152, 44100, 2, 32)),
+    # 工程音轨：192 kbps 44.1 kHz 的帧长在 626 和 627 之间交替
+    (dict(bitrate_index=11, rate_index=0, padding=1), (627, 1152, 44100, 2, 32)),
+    (dict(bitrate_index=9, rate_index=1, mono=True), (384, 1152, 48000, 1, 17)),
+    # edge-tts 的输出：MPEG-2 48 kbps 24 kHz 单声道
+    (dict(version=2, bitrate_index=6, rate_index=1, mono=True), (144, 576, 24000, 1, 9)),
+])
+def test_parse_mp3_header(fields, expected):
+    assert sts.parse_mp3_header(mp3_header(**fields), 0) == expected
+
+
+@pytest.mark.parametrize("data", [
+    b"\x00\x00\x00\x00",
+    mp3_header(bitrate_index=0),  # free format
+    mp3_header(bitrate_index=15),
+    mp3_header(rate_index=3),
+    mp3_header(version=1),  # 保留的版本号
+])
+def test_parse_mp3_header_rejects_invalid(data):
+    with pytest.raises(sts.ConversionError):
+        sts.parse_mp3_header(data, 0)
+
+
+def test_mp3_frames_skips_tags_and_info_frame():
+    id3 = b"ID3\x03\x00\x00\x00\x00\x01\x05" + bytes(0x85)  # 同步安全整数 0x01 0x05 = 133
+    info = bytearray(mp3_frame())
+    info[4 + 32:4 + 32 + 4] = b"Info"
+    audio = [mp3_frame(padding=1), mp3_frame(), mp3_frame(padding=1)]
+    data = id3 + bytes(info) + b"".join(audio) + b"TAG" + bytes(125)
+
+    offset, frames = sts.mp3_frames(data)
+
+    assert offset == len(id3) + len(info)
+    assert [length for _, length in frames] == [418, 417, 418]
+    assert frames[0][0] == offset
+    assert frames[-1][0] + frames[-1][1] == len(data) - 128
+
+
+def test_mp3_frames_keeps_first_frame_without_info_tag():
+    data = mp3_frame() + mp3_frame(padding=1)
+    assert sts.mp3_frames(data) == (0, [(0, 417), (417, 418)])
+
+
+CUES = [{'start': i * 1200, 'end': i * 1200 + 1000, 'key': f"cue{i}"} for i in range(8)]
+SEGMENTS = {cue['key']: tone(220 + 40 * i, 900) for i, cue in enumerate(CUES)}
+
+
+@pytest.mark.parametrize("changed", [0, 4, len(CUES) - 1])
+def test_patch_matches_full_render(tmp_path, changed):
+    logs = []
+    project = sts.RenderProject(str(tmp_path / "patched"))
+    project.render(CUES, SEGMENTS, None, 100, log=logs.append)
+    before = decode(project.audio_path)
+
+    cues = [dict(cue) for cue in CUES]
+    cues[changed]['key'] = "changed"
+    new_segment = {'changed': tone(1000, 900)}
+    project = sts.RenderProject(str(tmp_path / "patched"))
+    project.render(cues, new_segment, None, 100, log=logs.append)
+    reference = sts.RenderProject(str(tmp_path / "full"))
+    reference.render(cues, {**SEGMENTS, **new_segment}, None, 100, log=lambda message: None)
+
+    assert any("只重新渲染变化的 1 个区间" in message for message in logs)
+    with open(project.audio_path, 'rb') as f:
+        patched_data = f.read()
+    with open(reference.audio_path, 'rb') as f:
+        full_data = f.read()
+    # 替换后的文件仍然逐帧可解析，帧数与完整渲染相同
+    patched_start, patched_frames = sts.mp3_frames(patched_data)
+    full_start, full_frames = sts.mp3_frames(full_data)
+    assert patched_start == full_start
+    assert len(patched_frames) == len(full_frames)
+    assert patched_frames[-1][0] + patched_frames[-1][1] == len(patched_data)
+
+    patched = decode(project.audio_path)
+    full = decode(reference.audio_path)
+    assert len(patched) == len(full) == len(before)
+    # 帧偏移错一帧时差值与信号幅度相当，编码器上下文不同只带来很小的误差
+    assert np.abs(patched - full).max() < 400
+    start, end = sts.RenderProject._cue_range(cues[changed])
+    region = slice(start * sts.OUTPUT_CHANNELS, end * sts.OUTPUT_CHANNELS)
+    assert np.abs(patched[region] - before[region]).max() > 4000
@@ -0,0 +1,117 @@
+"""字幕排布：合并短字幕、借用空隙和最大加速倍数"""
+import numpy as np
+import pysubs2
+import pytest
+
+import subtitle_to_speech as sts
+
+
+def schedule(cues):
+    subs = [pysubs2.SSAEvent(start=start, end=end, text=f"第{n}句")
+            for n, (start, end) in enumerate(cues)]
+    return sts.schedule_cues(subs, [(n, event.text) for n, event in enumerate(subs)])
+
+
+# 每个时间段为 (字幕下标, 开始, 结束, 可用时长的终点)
+@pytest.mark.parametrize("cues, expected, overlapping", [
+    pytest.param(
+        [(0, 1000)], [([0], 0, 1000, 2000)], 0,
+        id="borrow-up-to-max",
+    ),
+    pytest.param(
+        [(0, 1000), (1500, 2500)], [([0], 0, 1000, 1400), ([1], 1500, 2500, 3500)], 0,
+        id="borrow-stops-before-next-cue",
+    ),
+    pytest.param(
+        [(0, 1000), (1050, 2000)], [([0], 0, 1000, 1000), ([1], 1050, 2000, 3000)], 0,
+        id="no-borrow-when-gap-too-small",
+    ),
+    pytest.param(
+        [(0, 500), (600, 1000), (1100, 1500)], [([0, 1, 2], 0, 1500, 2500)], 0,
+        id="merge-short-cues",
+    ),
+    pytest.param(
+        [(0, 500), (800, 1200)], [([0], 0, 500, 700), ([1], 800, 1200, 2200)], 0,
+        id="no-merge-across-long-gap",
+    ),
+    pytest.param(
+        [(0, 500), (600, 1500)], [([0], 0, 500, 500), ([1], 600, 1500, 2500)], 0,
+        id="no-merge-with-long-cue",
+    ),
+    pytest.param(
+        [(0, 500), (700, 1200), (1400, 1900), (2100, 2600), (2800, 3300)],
+        [([0, 1, 2, 3], 0, 2600, 2700), ([4], 2800, 3300, 4300)], 0,
+        id="merge-stops-at-total-limit",
+    ),
+    pytest.param(
+        [(0, 1000), (800, 1500), (3000, 3400)],
+        [([0], 0, 1000, 1000), ([1], 800, 1500, 1500), ([2], 3000, 3400, 4400)], 2,
+        id="overlapping-cues-neither-merge-nor-borrow",
+    ),
+    pytest.param(
+        [(0, 400), (300, 600)], [([0], 0, 400, 400), ([1], 300, 600, 600)], 2,
+        id="overlapping-short-cues-stay-apart",
+    ),
+    pytest.param(
+        [(0, 3000), (500, 1000), (2000, 2500)],
+        [([0], 0, 3000, 3000), ([1], 500, 1000, 1000), ([2], 2000, 2500, 2500)], 3,
+        id="cue-inside-a-long-cue-overlaps",
+    ),
+    pytest.param(
+        [(2000, 2500), (0, 1000)], [([1], 0, 1000, 1900), ([0], 2000, 2500, 3500)], 0,
+        id="out-of-order-input",
+    ),
+    pytest.param(
+        [(1000, 1000)], [([0], 1000, 1000, 2000)], 0,
+        id="zero-length-cue-borrows",
+    ),
+    pytest.param(
+        [(1000, 1000), (1000, 2000)], [([0], 1000, 1000, 1000), ([1], 1000, 2000, 3000)], 0,
+        id="zero-length-cue-before-next",
+    ),
+    pytest.param(
+        [(0, 500), (500, 500), (600, 1000)], [([0, 1, 2], 0, 1000, 2000)], 0,
+        id="zero-length-cue-merges",
+    ),
+])
+def test_schedule_cues(cues, expected, overlapping):
+    slots, count = schedule(cues)
+    assert [(slot['cues'], slot['start'], slot['end'], slot['limit']) for slot in slots] == expected
+    assert count == overlapping
+    for slot in slots:
+        assert slot['index'] == slot['cues'][0]
+        assert slot['text'] == " ".join(f"第{n}句" for n in slot['cues'])
+
+
+class RecordingStretcher:
+    """记录请求的加速倍数，原样返回采样，由 fit_segments 截断到加速后的长度"""
+
+    def __init__(self):
+        self.speeds = []
+
+    def stretch_batch(self, items):
+        self.speeds.extend(speed for _, speed in items)
+        return [samples for samples, _ in items]
+
+
+def frames(ms):
+    return int(round(ms * sts.OUTPUT_SAMPLE_RATE / 1000))
+
+
+# (可用时长, 语音时长, 请求的加速倍数, 放入时间线的时长)，时长为毫秒
+@pytest.mark.parametrize("window_ms, speech_ms, speed, placed_ms", [
+    pytest.param(1000, 800, None, 800, id="fits"),
+    pytest.param(1000, 1500, 1.5, 1000, id="stretched-to-window"),
+    pytest.param(1000, 2000, 2.0, 1000, id="exactly-at-cap"),
+    pytest.param(1000, 3000, sts.MAX_STRETCH_SPEED, 1500, id="capped-and-overflows"),
+])
+def test_fit_segments_caps_speed(window_ms, speech_ms, speed, placed_ms):
+    slots = {0: {'start': 1000, 'end': 1000 + window_ms, 'limit': 1000 + window_ms}}
+    samples = np.ones(frames(speech_ms), dtype=np.int16)
+    stretcher = RecordingStretcher()
+
+    segment, = sts.fit_segments(slots, {0: ("第0句", samples)}, stretcher)
+
+    assert stretcher.speeds == ([] if speed is None else [pytest.approx(speed)])
+    assert segment['start'] == 1000
+    assert len(segment['samples']) == frames(placed_ms)